@@ -0,0 +1,213 @@
+import atexit
+import datetime
+import json
+import logging
+import threading
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+import transaction
+from pyramid.security import authenticated_userid
+from sqlalchemy import (
+    MetaData,
+    Table,
+    Column,
+    Integer,
+    String,
+    DateTime,
+    Text,
+)
+
+from .models import has_request_user
+
+log = logging.getLogger(__name__)
+
+AUDIT_LOG_KEY = 'drypyramid.audit_log'
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+LOGIN = 'login'
+LOGIN_FAILED = 'login_failed'
+
+audit_metadata = MetaData()
+
+audit_log_table = Table(
+    'audit_log', audit_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('timestamp', DateTime, nullable=False),
+    Column('action', String(20), nullable=False),
+    Column('model', String(100)),
+    Column('record_id', String(100)),
+    Column('user_id', String(100)),
+    Column('changes', Text),
+)
+
+
+REDACTED = '[redacted]'
+
+
+def redact(data, keys):
+    """Return a copy of data with the values of keys replaced, a redacted
+    key in a dict_diff still shows that the value changed"""
+    return dict([(key, REDACTED if key in keys else value)
+                 for key, value in data.items()])
+
+
+def dict_diff(before, after):
+    """Return {key: (old, new)} for the keys whose values differ"""
+    keys = set(before) | set(after)
+    return dict([(key, (before.get(key), after.get(key))) for key in keys
+                 if before.get(key) != after.get(key)])
+
+
+def to_json(value):
+    return json.dumps(value, default=str, sort_keys=True)
+
+
+class FileAuditSink(object):
+    """Appends entries to a file as JSON lines"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, entries):
+        with open(self.path, 'a') as f:
+            f.writelines([to_json(entry) + '\n' for entry in entries])
+
+
+class TableAuditSink(object):
+    """Inserts entries into the audit_log table, creating it if need be"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        audit_metadata.create_all(engine, tables=[audit_log_table])
+
+    def write(self, entries):
+        rows = [dict(entry, changes=to_json(entry['changes']))
+                for entry in entries]
+        with self.engine.begin() as connection:
+            connection.execute(audit_log_table.insert(), rows)
+
+
+def request_user_id(request):
+    # request.user is already loaded by group_finder when it's set up
+    if has_request_user(request):
+        return None if request.user is None else request.user.id
+    return authenticated_userid(request)
+
+
+class AuditLog(object):
+    """Buffers audit entries in memory and writes them to the sink in batches
+    from a background thread.
+
+    If the buffer is full, entries are dropped (and counted in `dropped`)
+    unless block is True, in which case the request waits up to
+    block_timeout seconds for space. Entries still buffered are flushed on
+    stop() and at interpreter exit, entries buffered when the process is
+    killed are lost.
+    """
+
+    def __init__(self, sink, max_queue_size=10000, batch_size=500,
+                 flush_interval=1.0, block=False, block_timeout=1.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.block_timeout = block_timeout
+        self.queue = Queue(max_queue_size)
+        self.dropped = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='drypyramid-audit-log')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def put(self, entry):
+        try:
+            self.queue.put(entry, self.block, self.block_timeout)
+        except Full:
+            self.dropped += 1
+            log.warning("Audit log buffer is full, dropped an entry")
+
+    def get_batch(self, timeout=None):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout is not None, timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def flush(self):
+        batch = self.get_batch()
+        while batch:
+            self.write(batch)
+            batch = self.get_batch()
+
+    def write(self, batch):
+        try:
+            self.sink.write(batch)
+        except Exception:
+            log.exception("Failed to write %d audit entries", len(batch))
+
+    def run(self):
+        while not self.stopping.is_set():
+            batch = self.get_batch(self.flush_interval)
+            if batch:
+                self.write(batch)
+
+    def record(self, request, action, model=None, record_id=None,
+               changes=None):
+        """Buffer an entry once the current transaction commits, entries for
+        aborted transactions are discarded"""
+        entry = {
+            'timestamp': datetime.datetime.utcnow(),
+            'action': action,
+            'model': model,
+            'record_id': None if record_id is None else str(record_id),
+            'user_id': request_user_id(request),
+            'changes': changes,
+        }
+
+        def after_commit(success):
+            if success:
+                self.put(entry)
+        transaction.get().addAfterCommitHook(after_commit)
+
+
+def setup_audit_log(config, sink, **kwargs):
+    """Start an AuditLog writing to sink and make it available to the CRUD
+    and login views"""
+    audit_log = AuditLog(sink, **kwargs)
+    audit_log.start()
+    config.registry[AUDIT_LOG_KEY] = audit_log
+    return audit_log
+
+
+def get_audit_log(request):
+    return request.registry.get(AUDIT_LOG_KEY)
+
+
+def audit_record(request, action, record, changes):
+    """Record action on record if an audit log is set up, the record's
+    __redacted_columns__ are redacted from changes"""
+    audit_log = get_audit_log(request)
+    if audit_log is not None:
+        audit_log.record(request, action, record.__tablename__, record.id,
+                         redact(changes, record.__redacted_columns__))
@@ -4,6 +4,69 @@ from pyramid.security import has_permission
 
 pwd_context = CryptContext()
 
+# wrapped hashes are stored as $wrapped$<scheme>$<inner config>|<outer hash>
+WRAPPED_PREFIX = u'$wrapped$'
+PROBE_SECRET = 'drypyramid-probe'
+
+# per scheme, the index of the config candidate that works
+config_strategies = {}
+
+
+def config_candidates(hash):
+    candidates = []
+    if '$' in hash:
+        i = hash.rindex('$')
+        candidates.extend([hash[:i + 1], hash[:i]])
+    # e.g. des_crypt, a 2 char salt followed by the checksum
+    candidates.append(hash[:2])
+    return candidates
+
+
+def hash_config(hash, handler):
+    """Return hash's settings i.e. its salt and rounds without its checksum,
+    or None if they can't be separated"""
+    candidates = config_candidates(hash)
+    expected = handler.genhash(PROBE_SECRET, hash)
+    strategy = config_strategies.get(handler.name)
+    order = range(len(candidates)) if strategy is None else [strategy]
+    for i in order:
+        try:
+            if handler.genhash(PROBE_SECRET, candidates[i]) == expected:
+                config_strategies[handler.name] = i
+                return candidates[i]
+        except (ValueError, TypeError):
+            pass
+    return None
+
+
+def is_wrapped(hash):
+    return hash.startswith(WRAPPED_PREFIX)
+
+
+def wrap_hash(hash):
+    """Hash an outdated hash with the default scheme so it can be upgraded
+    without knowing the password. Only the old hash's settings are kept.
+    Returns None if they can't be separated from its checksum"""
+    handler = pwd_context.identify(hash, resolve=True)
+    config = hash_config(hash, handler)
+    if config is None or '|' in config:
+        return None
+    return u'{0}{1}${2}|{3}'.format(WRAPPED_PREFIX, handler.name, config,
+                                    pwd_context.encrypt(hash))
+
+
+def verify_wrapped(secret, wrapped):
+    scheme, rest = wrapped[len(WRAPPED_PREFIX):].split('$', 1)
+    config, outer = rest.rsplit('|', 1)
+    inner = pwd_context.handler(scheme).genhash(secret, config)
+    return pwd_context.verify(inner, outer)
+
+
+def needs_rehash(hash):
+    if is_wrapped(hash):
+        return pwd_context.needs_update(hash.rsplit('|', 1)[1])
+    return pwd_context.needs_update(hash)
+
 
 def permission_check_func(context, request):
     """ Attach a function for has_permission checks within templates.
@@ -0,0 +1,123 @@
+import threading
+from collections import OrderedDict
+
+import transaction
+from pyramid.renderers import RendererHelper
+from pyramid.response import Response
+from pyramid.security import effective_principals
+
+from .metrics import count
+
+
+class MemoryVersionStore(object):
+    """Per-table version counters for this process, use a shared store e.g.
+    backed by redis when running several workers. A store only needs get and
+    incr"""
+
+    def __init__(self):
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, table_names):
+        return tuple([self.versions.get(name, 0) for name in table_names])
+
+    def incr(self, table_name):
+        with self.lock:
+            self.versions[table_name] = self.versions.get(table_name, 0) + 1
+
+
+class MemoryRenderCache(object):
+    """LRU of rendered bodies limited to max_bytes, a shared backend only
+    needs get and set"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        body, content_type = value
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            if len(body) > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                evicted_key, (evicted_body, _) = self.entries.popitem(
+                    last=False)
+                self.size -= len(evicted_body)
+
+
+table_versions = MemoryVersionStore()
+render_cache = MemoryRenderCache()
+
+
+def set_cache_backends(versions=None, cache=None):
+    """Replace the version store and/or the render cache e.g. with shared
+    ones"""
+    global table_versions, render_cache
+    if versions is not None:
+        table_versions = versions
+    if cache is not None:
+        render_cache = cache
+
+
+def bump_table_versions(table_names):
+    """Bump the tables' versions once the current transaction commits, so a
+    render of uncommitted data is never cached under the new version"""
+    txn = transaction.get()
+    pending = getattr(txn, '_drypyramid_bumped_tables', None)
+    if pending is None:
+        pending = txn._drypyramid_bumped_tables = set()
+
+        def after_commit(success):
+            if success:
+                for name in pending:
+                    table_versions.incr(name)
+        txn.addAfterCommitHook(after_commit)
+    pending.update(table_names)
+
+
+def cached_render(view, renderer_name, table_names, package=None):
+    """Wrap view so its rendered response is cached, keyed by route, path,
+    query string, the user's principals and the tables' versions.
+
+    Only use this for templates that don't render per-session data e.g. flash
+    messages or CSRF tokens since those would be served to other users.
+    """
+    table_names = tuple(table_names)
+
+    def cached_view(context, request):
+        route = request.matched_route
+        key = (route.name if route else None, request.view_name,
+               request.path_qs,
+               tuple(sorted(effective_principals(request))),
+               table_versions.get(table_names))
+        cached = render_cache.get(key)
+        count(request, 'drypyramid_render_cache_total',
+              result='miss' if cached is None else 'hit')
+        if cached is not None:
+            body, content_type = cached
+            return Response(body=body, content_type=content_type)
+        value = view(context, request)
+        if isinstance(value, Response):
+            return value
+        # the system values the view would have been rendered with
+        helper = RendererHelper(name=renderer_name, package=package,
+                                registry=request.registry)
+        response = helper.render_view(request, value, view, context)
+        if response.status_int == 200:
+            render_cache.set(key, (response.body, response.content_type))
+        return response
+    return cached_view
@@ -0,0 +1,121 @@
+import unittest
+
+import transaction
+from pyramid import testing
+from sqlalchemy import (
+    create_engine,
+    event,
+)
+from sqlalchemy.pool import StaticPool
+from zope.sqlalchemy import mark_changed
+
+from .cache import bump_table_versions
+from .models import (
+    SASession,
+    Base,
+)
+
+_engines = {}
+
+
+def disable_pysqlite_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def begin_sqlite_transaction(connection):
+    connection.execute('BEGIN')
+
+
+def get_test_engine(url='sqlite://', metadata=Base.metadata):
+    """Return the engine for url, creating metadata's schema the first time
+    it's asked for in this process. An in-memory SQLite database is kept on
+    a single connection so it lives as long as the engine"""
+    key = (url, metadata)
+    engine = _engines.get(key)
+    if engine is None:
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            engine = create_engine(url, poolclass=StaticPool, connect_args={
+                'check_same_thread': False})
+        else:
+            engine = create_engine(url)
+        if engine.dialect.name == 'sqlite':
+            # pysqlite only BEGINs before DML, emit it ourselves so DDL run
+            # by a test is rolled back too
+            event.listen(engine, 'connect', disable_pysqlite_transactions)
+            event.listen(engine, 'begin', begin_sqlite_transaction)
+        metadata.create_all(engine)
+        _engines[key] = engine
+    return engine
+
+
+def seed(model, count, chunk_size=1000, **values):
+    """INSERT count rows of model with executemany, chunk_size rows per
+    statement. Each value is either a constant or a callable taking the row's
+    index e.g. name=lambda i: 'Person {0}'.format(i). Only for models mapped
+    to a single table, returns count"""
+    table = model.__table__
+    for start in range(0, count, chunk_size):
+        rows = []
+        for i in range(start, min(start + chunk_size, count)):
+            rows.append(dict([
+                (key, value(i) if callable(value) else value)
+                for key, value in values.items()]))
+        SASession.execute(table.insert(), rows)
+    mark_changed(SASession())
+    bump_table_versions([table.name])
+    return count
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Runs each test in a transaction on a schema created once per run,
+    the transaction is rolled back on tearDown so tests don't see each
+    other's data.
+
+    The session works inside a savepoint that's restarted whenever the
+    session's transaction ends. transaction.commit() inside a test keeps the
+    data visible until tearDown, transaction.abort() rolls back to the last
+    commit"""
+
+    database_url = 'sqlite://'
+    metadata = Base.metadata
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.engine = get_test_engine(self.database_url, self.metadata)
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self.committed = False
+        # kept so the same listeners can be removed
+        self.listeners = (('after_commit', self.mark_committed),
+                          ('after_transaction_end', self.restart_savepoint))
+        for name, listener in self.listeners:
+            event.listen(SASession, name, listener)
+        SASession.configure(bind=self.connection)
+
+    def mark_committed(self, session):
+        self.committed = True
+
+    def restart_savepoint(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        # the session only ends its sub-transaction of the connection's, a
+        # close or rollback doesn't reach the database
+        if self.savepoint.is_active:
+            if self.committed:
+                self.savepoint.commit()
+            else:
+                self.savepoint.rollback()
+        self.committed = False
+        self.savepoint = self.connection.begin_nested()
+
+    def tearDown(self):
+        for name, listener in self.listeners:
+            event.remove(SASession, name, listener)
+        transaction.abort()
+        SASession.remove()
+        if self.savepoint.is_active:
+            self.savepoint.rollback()
+        self.transaction.rollback()
+        self.connection.close()
+        testing.tearDown()
@@ -1,6 +1,11 @@
+import threading
+import weakref
+from collections import OrderedDict
+
 import colander
+from deform import Form
 from deform.widget import (
-    CheckboxWidget, PasswordWidget, CheckboxChoiceWidget
+    CheckboxWidget, PasswordWidget, CheckboxChoiceWidget, HiddenWidget
     )
 
 
@@ -11,6 +16,13 @@ class UserLoginForm(colander.MappingSchema):
         colander.String(encoding='utf-8'), widget=PasswordWidget())
 
 
+class VersionedForm(colander.MappingSchema):
+    """Base schema for Versioned models, round-trips the record's version so
+    stale updates can be rejected"""
+    version = colander.SchemaNode(
+        colander.Integer(), widget=HiddenWidget(), missing=None)
+
+
 class UserGroups(colander.SequenceSchema):
     name = colander.SchemaNode(
         colander.String(encoding='utf-8'), title="Group")
@@ -44,4 +56,91 @@ class BaseUserUpdateForm(BaseUserForm):
         description="Leave blank to leave unchanged", missing=None)
     confirm_password = colander.SchemaNode(
         colander.String(encoding='utf-8'), widget=PasswordWidget(),
-        missing=None)
\ No newline at end of file
+        missing=None)
+
+
+def depends_on_bindings(node):
+    """True if binding changes the schema i.e. it, or one of its children,
+    has deferred values or an after_bind callback"""
+    if getattr(node, 'after_bind', None) is not None:
+        return True
+    for name in dir(node):
+        if not name.startswith('__') and\
+                isinstance(getattr(node, name, None), colander.deferred):
+            return True
+    return any(depends_on_bindings(child) for child in node.children)
+
+
+def clone_field(field):
+    """Clone a deform field tree without re-running Field.__init__, which
+    rebuilds every child field from the schema."""
+    cloned = field.__class__.__new__(field.__class__)
+    cloned.__dict__.update(field.__dict__)
+    cloned.order = next(cloned.counter)
+    cloned.oid = 'deformField{0}'.format(cloned.order)
+    cloned._parent = None
+    children = []
+    for child in field.children:
+        cloned_child = clone_field(child)
+        cloned_child._parent = weakref.ref(cloned)
+        children.append(cloned_child)
+    cloned.children = children
+    return cloned
+
+
+class FormCache(object):
+    """LRU cache of bound schemas and their forms, keyed by schema class.
+    Callers get a fresh clone of the cached form so field state i.e. cstructs
+    and errors, doesn't leak between requests.
+
+    Schemas without deferreds are the same whatever they're bound to, so one
+    form serves every record, its clone validates with a copy of the schema
+    bound to the request's bind_kwargs so validators can read
+    node.bindings. Schemas with deferreds are only cached when bound without
+    arguments, the per record update forms are built for each request
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.prototypes = OrderedDict()
+        self.bound_schemas = {}
+        self.lock = threading.Lock()
+
+    def depends_on_bindings(self, schema_class):
+        result = self.bound_schemas.get(schema_class)
+        if result is None:
+            result = self.bound_schemas[schema_class] = depends_on_bindings(
+                schema_class.__call__())
+        return result
+
+    def get_form(self, schema_class, bind_kwargs=None, buttons=(),
+                 appstruct=colander.null):
+        bind_kwargs = bind_kwargs or {}
+        if bind_kwargs and self.depends_on_bindings(schema_class):
+            form = Form(schema_class.__call__().bind(**bind_kwargs),
+                        buttons=buttons)
+        else:
+            key = (schema_class, buttons)
+            with self.lock:
+                prototype = self.prototypes.pop(key, None)
+                if prototype is None:
+                    prototype = Form(schema_class.__call__().bind(),
+                                     buttons=buttons)
+                self.prototypes[key] = prototype
+                while len(self.prototypes) > self.max_size:
+                    self.prototypes.popitem(last=False)
+            form = clone_field(prototype)
+            if bind_kwargs:
+                # bind() binds a copy, the prototype's schema stays unbound
+                form.schema = prototype.schema.bind(**bind_kwargs)
+        if appstruct is not colander.null:
+            form.set_appstruct(appstruct)
+        return form
+
+    def clear(self):
+        with self.lock:
+            self.prototypes.clear()
+            self.bound_schemas.clear()
+
+
+form_cache = FormCache()
@@ -0,0 +1,188 @@
+import logging
+import time
+
+from pyramid.response import Response
+from pyramid.threadlocal import get_current_request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+
+class QueryLimitExceeded(Exception):
+    status_code = 503
+    message = u"The server is too busy to complete this request."
+
+    def __init__(self, statement=None):
+        super(QueryLimitExceeded, self).__init__(statement)
+        self.statement = statement
+
+
+class StatementTimeout(QueryLimitExceeded):
+    pass
+
+
+class TooManyQueries(QueryLimitExceeded):
+    pass
+
+
+class TooManyRows(QueryLimitExceeded):
+    status_code = 413
+    message = u"Too many records were requested, please narrow the filter."
+
+
+class QueryBudget(object):
+    """Limits for the statements executed while handling a request.
+
+    statement_timeout is in seconds. It is enforced by the database on
+    PostgreSQL, and on MySQL for SELECTs through the MAX_EXECUTION_TIME
+    optimizer hint. It's interrupted via a progress handler on SQLite. Other
+    statements and dialects are checked once the statement completes"""
+
+    def __init__(self, statement_timeout=None, max_queries=None):
+        self.statement_timeout = statement_timeout
+        self.max_queries = max_queries
+        self.queries = 0
+        self.started = None
+        self.timed_out_connections = set()
+
+
+def get_budget():
+    request = get_current_request()
+    if request is None:
+        return None
+    return getattr(request, 'query_budget', None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    budget = get_budget()
+    if budget is None:
+        return statement, parameters
+    budget.queries += 1
+    if budget.max_queries is not None and\
+            budget.queries > budget.max_queries:
+        log.warning("Query budget of %d exceeded by: %s",
+                    budget.max_queries, statement)
+        raise TooManyQueries(statement)
+    if budget.statement_timeout is None:
+        return statement, parameters
+    budget.started = time.time()
+    dialect = conn.dialect.name
+    dbapi_connection = conn.connection
+    if dialect == 'postgresql' and\
+            id(dbapi_connection) not in budget.timed_out_connections:
+        # lasts until the request's transaction ends
+        cursor.execute("SET LOCAL statement_timeout = {0:d}".format(
+            int(budget.statement_timeout * 1000)))
+        budget.timed_out_connections.add(id(dbapi_connection))
+    elif dialect == 'mysql':
+        statement = add_max_execution_time(statement,
+                                           budget.statement_timeout)
+    elif dialect == 'sqlite':
+        deadline = budget.started + budget.statement_timeout
+        dbapi_connection.set_progress_handler(
+            lambda: time.time() > deadline, 1000)
+    return statement, parameters
+
+
+def add_max_execution_time(statement, timeout):
+    """Add MySQL's MAX_EXECUTION_TIME hint to a SELECT statement, the server
+    ignores it on other statements"""
+    stripped = statement.lstrip()
+    if stripped[:6].upper() != 'SELECT':
+        return statement
+    return "SELECT /*+ MAX_EXECUTION_TIME({0:d}) */{1}".format(
+        int(timeout * 1000), stripped[6:])
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    budget = get_budget()
+    if budget is None or budget.statement_timeout is None:
+        return
+    if conn.dialect.name == 'sqlite':
+        conn.connection.set_progress_handler(None, 0)
+    elif time.time() - budget.started > budget.statement_timeout:
+        log.warning("Statement exceeded %ss: %s", budget.statement_timeout,
+                    statement)
+        raise StatementTimeout(statement)
+
+
+def is_statement_timeout(dialect_name, error):
+    """True if the DBAPI error is the database cancelling a statement that
+    ran out of time"""
+    if dialect_name == 'postgresql':
+        # query_canceled
+        return getattr(error, 'pgcode', None) == '57014'
+    if dialect_name == 'mysql':
+        # ER_QUERY_TIMEOUT
+        args = getattr(error, 'args', ())
+        return bool(args) and args[0] == 3024
+    if dialect_name == 'sqlite':
+        return 'interrupted' in str(error)
+    return False
+
+
+def handle_error(exception_context):
+    budget = get_budget()
+    if budget is None or budget.statement_timeout is None or\
+            budget.started is None:
+        return
+    connection = exception_context.connection
+    if connection is None:
+        return
+    dialect_name = connection.dialect.name
+    if dialect_name == 'sqlite':
+        connection.connection.set_progress_handler(None, 0)
+    if is_statement_timeout(dialect_name,
+                            exception_context.original_exception):
+        log.warning("Statement exceeded %ss: %s", budget.statement_timeout,
+                    exception_context.statement)
+        raise StatementTimeout(exception_context.statement)
+
+
+def limit_queries(limits):
+    """Return a view decorator running the view with a QueryBudget built from
+    the limits dict. Queries already counted by a limit_traversal_queries
+    budget count towards it"""
+    def decorator(view):
+        def inner(context, request):
+            previous = getattr(request, 'query_budget', None)
+            request.query_budget = QueryBudget(**limits)
+            if previous is not None:
+                request.query_budget.queries = previous.queries
+            try:
+                return view(context, request)
+            finally:
+                request.query_budget = None
+        return inner
+    return decorator
+
+
+def limit_traversal_queries(factory, limits):
+    """Return a root factory starting a QueryBudget built from the limits
+    dict before factory, so the queries made while traversing e.g. loading
+    the record are limited too"""
+    def budgeted_factory(request):
+        request.query_budget = QueryBudget(**limits)
+        return factory(request)
+    return budgeted_factory
+
+
+def query_limit_exceeded(exc, request):
+    response = Response(exc.message, status=exc.status_code,
+                        content_type='text/plain')
+    return response
+
+
+def setup_query_limits(config):
+    """Enforce ModelView query limits, returning a 503 or 413 when they are
+    exceeded"""
+    listeners = (('before_cursor_execute', before_cursor_execute, True),
+                 ('after_cursor_execute', after_cursor_execute, False),
+                 ('handle_error', handle_error, False))
+    for name, listener, retval in listeners:
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener, retval=retval)
+    config.add_view(query_limit_exceeded, context=QueryLimitExceeded)
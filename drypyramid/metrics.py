@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from pyramid.response import Response
+from pyramid.threadlocal import get_current_registry
+
+METRICS_KEY = 'drypyramid.metrics'
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+HELP = {
+    'drypyramid_view_requests_total': "ModelView requests",
+    'drypyramid_view_errors_total': "ModelView requests that raised",
+    'drypyramid_view_seconds': "ModelView latency including rendering",
+    'drypyramid_logins_total': "Login attempts by result",
+    'drypyramid_password_check_seconds': "Password verification time",
+    'drypyramid_group_finder_calls_total':
+        "group_finder calls by whether request.user was already loaded",
+    'drypyramid_render_cache_total': "Render cache lookups by result",
+    'drypyramid_form_validation_failures_total':
+        "Form submissions that failed validation",
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = [u'{0}="{1}"'.format(name, u'{0}'.format(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels]
+    return u'{' + u','.join(pairs) + u'}'
+
+
+class Metrics(object):
+    """Counters and histograms for this worker process.
+
+    Each thread updates its own shard so recording takes no lock, shards are
+    summed when collected. Every sample is labelled with the worker's pid so
+    workers scraped through the same address are told apart"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.local = threading.local()
+        self.shards = []
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = ({}, {})
+            self.shards.append(shard)
+            return shard
+
+    def inc(self, name, value=1, **labels):
+        counters = self.shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add value to a histogram, stored as per bucket counts followed by
+        the sum"""
+        histograms = self.shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) +\
+                [0.0]
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def collect(self):
+        """Return the summed ({key: count}, {key: histogram})"""
+        counters = {}
+        histograms = {}
+        for shard_counters, shard_histograms in list(self.shards):
+            # copies are atomic, other threads may be recording
+            for key, value in shard_counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in shard_histograms.copy().items():
+                total = histograms.setdefault(key, [0] * len(histogram))
+                for i, value in enumerate(list(histogram)):
+                    total[i] += value
+        return counters, histograms
+
+    def render(self):
+        """The metrics in the Prometheus text format"""
+        counters, histograms = self.collect()
+        worker = (('worker', os.getpid()),)
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(u'# HELP {0} {1}'.format(name, HELP[name]))
+                lines.append(u'# TYPE {0} {1}'.format(name, kind))
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, 'counter')
+            lines.append(u'{0}{1} {2}'.format(
+                name, format_labels(labels + worker), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            describe(name, 'histogram')
+            labels = labels + worker
+            count = 0
+            bounds = [repr(b) for b in self.buckets] + ['+Inf']
+            for bound, value in zip(bounds, histogram[:-1]):
+                count += value
+                lines.append(u'{0}_bucket{1} {2}'.format(
+                    name, format_labels(labels + (('le', bound),)), count))
+            lines.append(u'{0}_sum{1} {2!r}'.format(
+                name, format_labels(labels), histogram[-1]))
+            lines.append(u'{0}_count{1} {2}'.format(
+                name, format_labels(labels), count))
+        return u'\n'.join(lines) + u'\n'
+
+
+def get_metrics(request=None):
+    """The Metrics if set up, request defaults to the current one for code
+    that doesn't have it e.g. models"""
+    registry = get_current_registry() if request is None else\
+        request.registry
+    return registry.get(METRICS_KEY)
+
+
+def count(request, name, value=1, **labels):
+    """Increment a counter if metrics are set up"""
+    metrics = get_metrics(request)
+    if metrics is not None:
+        metrics.inc(name, value, **labels)
+
+
+def observe(request, name, value, **labels):
+    """Add to a histogram if metrics are set up"""
+    metrics = get_metrics(request)
+    if metrics is not None:
+        metrics.observe(name, value, **labels)
+
+
+def metered_view(route_name, action):
+    """Return a view decorator counting and timing requests"""
+    def decorator(view):
+        def inner(context, request):
+            metrics = get_metrics(request)
+            if metrics is None:
+                return view(context, request)
+            start = time.time()
+            try:
+                return view(context, request)
+            except Exception:
+                metrics.inc('drypyramid_view_errors_total', route=route_name,
+                            action=action)
+                raise
+            finally:
+                metrics.inc('drypyramid_view_requests_total',
+                            route=route_name, action=action)
+                metrics.observe('drypyramid_view_seconds',
+                                time.time() - start, route=route_name,
+                                action=action)
+        return inner
+    return decorator
+
+
+def metrics_view(request):
+    return Response(body=get_metrics(request).render().encode('utf-8'),
+                    content_type='text/plain', charset='utf-8')
+
+
+def setup_metrics(config, path='/metrics', permission=None, **kwargs):
+    """Start collecting metrics and serve them at path, protect it with
+    permission unless it's only reachable internally. kwargs are passed to
+    Metrics"""
+    metrics = Metrics(**kwargs)
+    config.registry[METRICS_KEY] = metrics
+    config.add_route('drypyramid_metrics', path)
+    config.add_view(metrics_view, route_name='drypyramid_metrics',
+                    permission=permission)
+    return metrics
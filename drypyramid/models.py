@@ -1,3 +1,18 @@
+import datetime
+import time
+from decimal import Decimal
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+import transaction
 from sqlalchemy import (
     Column,
     Integer,
@@ -5,28 +20,205 @@ from sqlalchemy import (
     Boolean,
     Table,
     ForeignKey,
+    DateTime,
+    Index,
+)
+from sqlalchemy import (
+    inspect,
+    and_,
+    event,
+    exists,
+    literal,
+    select,
+)
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import (
+    declarative_base,
+    declared_attr,
 )
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm import (
     scoped_session,
     sessionmaker,
     relationship,
     synonym,
     backref,
+    make_transient_to_detached,
+    joinedload,
+)
+from sqlalchemy.util import (
+    ScopedRegistry,
+    ThreadLocalRegistry,
 )
-from zope.sqlalchemy import ZopeTransactionExtension
+from pyramid.events import NewRequest
+from pyramid.httpexceptions import HTTPMovedPermanently
+from pyramid.security import unauthenticated_userid
+from pyramid.threadlocal import get_current_request
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 from slugify import slugify
-from .auth import pwd_context
+from .cache import bump_table_versions
+from .metrics import count, observe
+from .auth import (
+    pwd_context,
+    is_wrapped,
+    verify_wrapped,
+)
 
 SASession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 
 
+def request_scope():
+    """Session scopefunc that keys sessions on the current request, falling
+    back to the current thread (or greenlet, when monkey patched) outside of
+    a request"""
+    request = get_current_request()
+    if request is not None:
+        return request
+    return get_ident()
+
+
+def set_session_scopefunc(scopefunc):
+    """Change how SASession is scoped, a scopefunc of None restores the
+    default thread-local scope"""
+    SASession.remove()
+    if scopefunc is not None:
+        SASession.registry = ScopedRegistry(
+            SASession.session_factory, scopefunc)
+    else:
+        SASession.registry = ThreadLocalRegistry(SASession.session_factory)
+
+
+def remove_session(request):
+    SASession.remove()
+
+
+def add_session_finished_callback(event):
+    event.request.add_finished_callback(remove_session)
+
+
+def get_dbsession(request):
+    return SASession()
+
+
+def setup_request_session(config, scopefunc=request_scope):
+    """Scope SASession to each request and expose it as request.dbsession.
+
+    The session is removed once the request is finished so it is never shared
+    across concurrent requests regardless of whether the worker uses threads,
+    greenlets or processes
+    """
+    set_session_scopefunc(scopefunc)
+    config.add_request_method(get_dbsession, 'dbsession', reify=True)
+    config.add_subscriber(add_session_finished_callback, NewRequest)
+
+
+NUMERIC_TYPES = (int, float, Decimal)
+
+BOOLEAN_STRINGS = {'true': True, '1': True, 'false': False, '0': False}
+
+
 def prettify(value):
     return ' '.join([w.capitalize() for w in value.split('_')])
 
 
+def coerce_value(column, value):
+    """Coerce string values to a numeric or boolean column's python type so
+    they can be compared against the loaded value. Booleans are parsed from
+    BOOLEAN_STRINGS, other strings are returned as is"""
+    if not isinstance(value, string_types):
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    # bool is a subclass of int, bool('false') is True
+    if issubclass(python_type, bool):
+        return BOOLEAN_STRINGS.get(value.lower(), value)
+    if issubclass(python_type, NUMERIC_TYPES):
+        try:
+            return python_type(value)
+        except (TypeError, ValueError, ArithmeticError):
+            pass
+    return value
+
+
+def insert_ignore(table, dialect):
+    """An INSERT for table that skips rows violating unique constraints
+    using the dialect's native syntax.
+
+    SQLite's OR IGNORE also skips rows violating NOT NULL constraints, see
+    check_required_values. MySQL's ON DUPLICATE KEY UPDATE only skips
+    duplicate keys, unlike INSERT IGNORE which downgrades e.g. truncation to
+    a warning"""
+    if dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect.name == 'sqlite':
+        # SQLite's ON CONFLICT IGNORE
+        return table.insert().prefix_with('OR IGNORE')
+    elif dialect.name == 'mysql':
+        # setting the primary key to its current value leaves duplicates
+        # unchanged
+        pk = list(table.primary_key.columns)[0]
+        return mysql.insert(table).on_duplicate_key_update({pk.name: pk})
+    raise NotImplementedError(
+        "insert_ignore is not supported for {0}".format(dialect.name))
+
+
+def required_columns(table):
+    """NOT NULL columns the database doesn't fill in"""
+    return [c for c in table.columns if not c.nullable and
+            c.default is None and c.server_default is None and
+            not (c.primary_key and c.autoincrement)]
+
+
+def check_required_values(table, rows):
+    """Raise a ValueError if a row lacks a value for a NOT NULL column, an
+    insert_ignore would silently skip it on SQLite"""
+    columns = required_columns(table)
+    for row in rows:
+        for column in columns:
+            if row.get(column.key) is None:
+                raise ValueError("{0}.{1} is required".format(
+                    table.name, column.key))
+
+
+def is_unique_violation(error):
+    """True if the IntegrityError was raised by a unique constraint"""
+    orig = error.orig
+    pgcode = getattr(orig, 'pgcode', None)
+    if pgcode is not None:
+        return pgcode == '23505'
+    args = getattr(orig, 'args', ())
+    if args and args[0] == 1062:
+        # MySQL's ER_DUP_ENTRY
+        return True
+    message = str(orig)
+    return 'UNIQUE constraint failed' in message or\
+        'is not unique' in message
+
+
+def iter_id_chunks(model, criterion=None, chunk_size=1000):
+    """Yield lists of model's ids matching criterion in primary key order,
+    chunk_size ids at a time"""
+    last_id = None
+    while True:
+        query = SASession.query(model.id)
+        if criterion is not None:
+            query = query.filter(criterion)
+        if last_id is not None:
+            query = query.filter(model.id > last_id)
+        ids = [row[0] for row in query.order_by(model.id).limit(chunk_size)]
+        if not ids:
+            break
+        yield ids
+        last_id = ids[-1]
+
+
 class Model(object):
+    # columns never written to audit entries or JSON views e.g. password
+    # hashes
+    __redacted_columns__ = ()
+
     def save(self):
         SASession.add(self)
 
@@ -37,6 +229,159 @@ class Model(object):
     def delete(self):
         SASession.delete(self)
 
+    @classmethod
+    def delete_by_ids(cls, ids):
+        """Delete records by primary key without loading them, rows in
+        association tables are deleted first as a set.
+
+        Unlike delete(), no ORM cascades or mapper events are run"""
+        ids = list(ids)
+        if not ids:
+            return 0
+        for column in cls.association_columns():
+            SASession.execute(
+                column.table.delete().where(column.in_(ids)))
+            bump_table_versions([column.table.name])
+        if issubclass(cls, ChangeTracked):
+            cls.log_deletes(ids)
+        return SASession.query(cls).filter(cls.id.in_(ids)).delete(
+            synchronize_session=False)
+
+    @classmethod
+    def delete_where(cls, criterion, chunk_size=1000, max_chunks=None,
+                     commit_chunks=False):
+        """Delete the records matching criterion chunk_size records at a
+        time, committing after each chunk if commit_chunks is True so locks
+        are only held for a chunk. Returns the number of deleted records"""
+        return cls.apply_in_chunks(cls.delete_by_ids, criterion, chunk_size,
+                                   max_chunks, commit_chunks)
+
+    @classmethod
+    def apply_in_chunks(cls, func, criterion, chunk_size, max_chunks,
+                        commit_chunks):
+        """Call func with the ids of chunk_size records matching criterion
+        until none match, func must make them stop matching e.g. delete
+        them. Returns the sum of func's return values"""
+        total = 0
+        chunks = 0
+        while max_chunks is None or chunks < max_chunks:
+            ids = [row[0] for row in SASession.query(cls.id).filter(
+                criterion).order_by(cls.id).limit(chunk_size)]
+            if not ids:
+                break
+            total += func(ids)
+            chunks += 1
+            if commit_chunks:
+                transaction.commit()
+        return total
+
+    @classmethod
+    def association_columns(cls):
+        """Columns in association (secondary) tables that reference this
+        model"""
+        columns = []
+        for relation in cls.__mapper__.relationships:
+            if relation.secondary is None:
+                continue
+            for local_column, column in relation.synchronize_pairs:
+                if column.table is relation.secondary and\
+                        not any(c is column for c in columns):
+                    columns.append(column)
+        return columns
+
+    def insert_values(self):
+        state = inspect(self)
+        mapper = state.mapper
+        if mapper.version_id_col is not None:
+            version_key = mapper.get_property_by_column(
+                mapper.version_id_col).key
+            if getattr(self, version_key) is None:
+                setattr(self, version_key, 1)
+        return dict([(prop.columns[0].key, state.dict[prop.key])
+                     for prop in mapper.column_attrs
+                     if prop.key in state.dict])
+
+    def can_insert_directly(self, values):
+        """A single INSERT only writes the record's own columns. Records that
+        are already in a session, have related records set, lack required
+        values or whose mapper has insert listeners e.g. set_slug or
+        ChangeTracked's need a flush"""
+        state = inspect(self)
+        mapper = state.mapper
+        if state.session_id is not None or state.key is not None:
+            return False
+        if mapper.dispatch.before_insert or mapper.dispatch.after_insert:
+            return False
+        if any(state.dict.get(relation.key)
+               for relation in mapper.relationships):
+            return False
+        return all(values.get(column.key) is not None
+                   for column in required_columns(self.__table__))
+
+    def insert_or_ignore(self):
+        """INSERT this record unless that would violate a unique constraint.
+        Returns True and attaches the record to the session if it was
+        inserted.
+
+        Records that can_insert_directly are written with the dialect's
+        insert-or-ignore, without a flush or a query to check for duplicates
+        first. Others are flushed in a savepoint that is rolled back on a
+        unique violation. So are all records on MySQL, whose affected row
+        count doesn't tell a duplicate from an insert"""
+        values = self.insert_values()
+        dialect = SASession.get_bind(mapper=inspect(self).mapper).dialect
+        if dialect.name == 'mysql' or not self.can_insert_directly(values):
+            return self.flush_or_ignore()
+        result = SASession.execute(
+            insert_ignore(self.__table__, dialect), values)
+        mark_changed(SASession())
+        if result.rowcount != 1:
+            return False
+        bump_table_versions([self.__table__.name])
+        self.id = result.inserted_primary_key[0]
+        make_transient_to_detached(self)
+        SASession.add(self)
+        return True
+
+    def flush_or_ignore(self):
+        """Flush this record in a savepoint, returns False and removes it
+        from the session if that violates a unique constraint"""
+        # begin_nested flushes pending records, a record cascaded into the
+        # session e.g. through a backref must only be flushed in the savepoint
+        if self in SASession:
+            SASession.expunge(self)
+        savepoint = SASession.begin_nested()
+        SASession.add(self)
+        try:
+            SASession.flush()
+        except IntegrityError as e:
+            savepoint.rollback()
+            if not is_unique_violation(e):
+                raise
+            if self in SASession:
+                SASession.expunge(self)
+            return False
+        savepoint.commit()
+        return True
+
+    @classmethod
+    def bulk_insert_or_ignore(cls, rows):
+        """INSERT rows (dicts of column values) skipping those that would
+        violate a unique constraint, returns the number of inserted rows.
+
+        Like delete_by_ids, mapper events are not run. Raises a ValueError
+        if a row lacks a required value. On MySQL duplicates are counted too,
+        they're reported as found rows"""
+        if not rows:
+            return 0
+        check_required_values(cls.__table__, rows)
+        dialect = SASession.get_bind(mapper=cls.__mapper__).dialect
+        result = SASession.execute(
+            insert_ignore(cls.__table__, dialect), rows)
+        mark_changed(SASession())
+        bump_table_versions([cls.__table__.name])
+        return result.rowcount
+
     @classmethod
     def create_from_dict(cls, data):
         record = cls.__call__()
@@ -48,7 +393,26 @@ class Model(object):
                      self.__mapper__.columns])
 
     def update_from_dict(self, data):
-        [setattr(self, key, data.get(key)) for key in data]
+        """Only set the keys whose values differ from the current ones and
+        return the set of changed keys"""
+        columns = self.__mapper__.columns
+        changed = set()
+        for key in data:
+            value = data.get(key)
+            if key in columns:
+                value = coerce_value(columns[key], value)
+            if getattr(self, key, None) != value:
+                setattr(self, key, value)
+                changed.add(key)
+        return changed
+
+    def __getitem__(self, key):
+        """Traverse into a child collection declared on the record's
+        factory"""
+        parent = getattr(self, '__parent__', None)
+        if not hasattr(parent, 'get_child_collection'):
+            raise KeyError(key)
+        return parent.get_child_collection(self, key)
 
     @property
     def __prettyname__(self):
@@ -57,6 +421,37 @@ class Model(object):
 
 Base = declarative_base(cls=Model)
 
+
+def bump_flushed_tables(session, flush_context):
+    """Bump the versions of the tables touched by a flush, including their
+    association tables"""
+    table_names = set()
+    for instance in set(session.new) | set(session.dirty) |\
+            set(session.deleted):
+        model = instance.__class__
+        table_names.update([t.name for t in model.__mapper__.tables])
+        if isinstance(instance, Model):
+            table_names.update(
+                [c.table.name for c in model.association_columns()])
+    if table_names:
+        bump_table_versions(table_names)
+
+
+def bump_bulk_table(update_context):
+    bump_table_versions([update_context.primary_table.name])
+
+
+def listen_for_table_changes():
+    """Bump the versions of the tables changed through SASession, only
+    needed once a view's render is cached"""
+    listeners = (('after_flush', bump_flushed_tables),
+                 ('after_bulk_update', bump_bulk_table),
+                 ('after_bulk_delete', bump_bulk_table))
+    for name, listener in listeners:
+        if not event.contains(SASession, name, listener):
+            event.listen(SASession, name, listener)
+
+
 user_group = Table(
     'user_groups', Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id')),
@@ -83,6 +478,31 @@ def set_slug(mapper, connection, target):
     target.__setattr__(target_column.name, slug)
 
 
+slug_redirect = Table(
+    'slug_redirects', Base.metadata,
+    Column('table_name', String(100), primary_key=True),
+    Column('slug', String(255), primary_key=True),
+    Column('record_id', Integer, nullable=False),
+)
+
+
+def record_slug_change(mapper, connection, target):
+    """before_update listener that keeps a Slugable record's previous slug
+    so ModelFactory can redirect it"""
+    key = mapper.class_.slug_target_column().key
+    history = inspect(target).attrs[key].history
+    if not (history.added and history.deleted and history.deleted[0]):
+        return
+    old_slug = history.deleted[0]
+    table_name = mapper.local_table.name
+    # the new slug may have been used before
+    connection.execute(slug_redirect.delete().where(and_(
+        slug_redirect.c.table_name == table_name,
+        slug_redirect.c.slug.in_([old_slug, history.added[0]]))))
+    connection.execute(slug_redirect.insert().values(
+        table_name=table_name, slug=old_slug, record_id=target.id))
+
+
 class Slugable(object):
     def slug_unique_query(self):
         raise NotImplementedError
@@ -96,16 +516,216 @@ class Slugable(object):
         return cls.name
 
 
-def group_finder(user_id, request):
-    try:
-        # todo: join with groups
-        user = BaseUser.query().filter(BaseUser.id == user_id).one()
-    except NoResultFound:
+class Versioned(object):
+    """Optimistic concurrency control, updates only succeed if the row's
+    version hasn't changed since it was loaded"""
+    version = Column(Integer, nullable=False)
+
+    @declared_attr
+    def __mapper_args__(cls):
+        return {'version_id_col': cls.version}
+
+    def is_stale(self, version):
+        return version is not None and version != self.version
+
+
+change_log = Table(
+    'change_log', Base.metadata,
+    Column('seq', Integer, primary_key=True),
+    Column('table_name', String(100), nullable=False),
+    Column('record_id', Integer, nullable=False),
+    Column('operation', String(10), nullable=False),
+    Column('logged_at', DateTime, nullable=False,
+           default=datetime.datetime.utcnow),
+    Index('ix_change_log_table_name_seq', 'table_name', 'seq'),
+)
+
+
+def log_change(operation):
+    def listener(mapper, connection, target):
+        connection.execute(change_log.insert().values(
+            table_name=mapper.local_table.name, record_id=target.id,
+            operation=operation))
+    return listener
+
+
+class ChangeTracked(object):
+    """Inserts, updates and deletes are logged to change_log with an
+    increasing sequence number so clients can fetch what changed since a
+    cursor, see changes_since.
+
+    Bulk inserts (bulk_insert_or_ignore) and bulk updates bypass the log"""
+    INSERT = 'insert'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    @classmethod
+    def log_deletes(cls, ids):
+        """Log tombstones for records deleted without mapper events e.g. by
+        delete_by_ids. Soft deleted records already have theirs, purging
+        them logs nothing"""
+        query = select([literal(cls.__tablename__), cls.id,
+                        literal(cls.DELETE)]).where(cls.id.in_(ids))
+        if issubclass(cls, SoftDeletable):
+            query = query.where(cls.deleted_at == None)
+        SASession.execute(change_log.insert().from_select(
+            ['table_name', 'record_id', 'operation'], query))
+
+    @classmethod
+    def changes_since(cls, cursor, limit=500, lag=0):
+        """Return ([(seq, record_id, record or None)], has_more) for changes
+        after cursor. Records are loaded with a single IN query, deleted ones
+        are returned as None i.e. tombstones. Only the latest change to a
+        record in the page is included.
+
+        Sequence numbers are taken when a change is logged, not when its
+        transaction commits, so a change can become visible after later ones
+        have been returned. Only changes logged more than lag seconds ago are
+        returned, a client never skips a change as long as lag is longer than
+        the slowest transaction and the servers' clocks agree"""
+        query = SASession.query(
+            change_log.c.seq, change_log.c.record_id).filter(
+            change_log.c.table_name == cls.__tablename__,
+            change_log.c.seq > cursor)
+        if lag:
+            query = query.filter(
+                change_log.c.logged_at <= datetime.datetime.utcnow() -
+                datetime.timedelta(seconds=lag))
+        rows = query.order_by(change_log.c.seq).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        latest = {}
+        for seq, record_id in rows:
+            latest[record_id] = seq
+        records = {}
+        if latest:
+            # bypass soft delete filtering, those are tombstones too
+            records = dict([
+                (r.id, r) for r in SASession.query(cls).filter(
+                    cls.id.in_(list(latest.keys())))
+                if not getattr(r, 'is_deleted', False)])
+        changes = sorted([(seq, record_id, records.get(record_id))
+                          for record_id, seq in latest.items()])
+        return changes, has_more
+
+
+event.listen(ChangeTracked, 'after_insert', log_change(ChangeTracked.INSERT),
+             propagate=True)
+event.listen(ChangeTracked, 'after_update', log_change(ChangeTracked.UPDATE),
+             propagate=True)
+event.listen(ChangeTracked, 'after_delete', log_change(ChangeTracked.DELETE),
+             propagate=True)
+
+
+class SoftDeletable(object):
+    """Records are marked as deleted instead of being deleted and are
+    excluded from query(). Use purge_deleted to hard delete them later"""
+    deleted_at = Column(DateTime, nullable=True)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (Index('ix_{0}_deleted_at_id'.format(cls.__tablename__),
+                      'deleted_at', 'id'),)
+
+    @classmethod
+    def query(cls, **kwargs):
+        return cls.query_with_deleted(**kwargs).filter(
+            cls.deleted_at == None)
+
+    @classmethod
+    def query_with_deleted(cls, **kwargs):
+        return super(SoftDeletable, cls).query(**kwargs)
+
+    def delete(self):
+        self.deleted_at = datetime.datetime.utcnow()
+
+    @classmethod
+    def soft_delete_by_ids(cls, ids):
+        """Mark records as deleted by primary key without loading them,
+        records that already are deleted are left alone"""
+        ids = list(ids)
+        if not ids:
+            return 0
+        if issubclass(cls, ChangeTracked):
+            cls.log_deletes(ids)
+        return SASession.query(cls).filter(
+            cls.id.in_(ids), cls.deleted_at == None).update(
+            {cls.deleted_at: datetime.datetime.utcnow()},
+            synchronize_session=False)
+
+    @classmethod
+    def soft_delete_where(cls, criterion, chunk_size=1000, max_chunks=None,
+                          commit_chunks=False):
+        """Mark the records matching criterion as deleted with chunked
+        UPDATEs, like delete_where. Returns the number of marked records"""
+        return cls.apply_in_chunks(
+            cls.soft_delete_by_ids, and_(criterion, cls.deleted_at == None),
+            chunk_size, max_chunks, commit_chunks)
+
+    @property
+    def is_deleted(self):
+        return self.deleted_at is not None
+
+    @classmethod
+    def purge_deleted(cls, older_than, chunk_size=500, pause=0.0,
+                      max_chunks=None):
+        """Hard delete records soft deleted before older_than, committing
+        after each chunk and sleeping pause seconds in between to throttle
+        the load on the database. Returns the number of purged records"""
+        criterion = cls.deleted_at < older_than
+        purged = 0
+        chunks = 0
+        while max_chunks is None or chunks < max_chunks:
+            deleted = cls.delete_where(criterion, chunk_size=chunk_size,
+                                       max_chunks=1, commit_chunks=True)
+            purged += deleted
+            chunks += 1
+            if deleted < chunk_size:
+                break
+            if pause:
+                time.sleep(pause)
+        return purged
+
+
+def load_user(user_id):
+    """Load an active user with their groups in a single query"""
+    return BaseUser.query().options(joinedload(BaseUser.groups)).filter(
+        BaseUser.id == user_id, BaseUser.is_active == True).first()
+
+
+def get_user(request):
+    """The authenticated user, or None if not logged in or inactive"""
+    user_id = unauthenticated_userid(request)
+    if user_id is None:
         return None
+    return load_user(user_id)
+
+
+def setup_request_user(config):
+    """Add request.user, loaded once per request and shared with
+    group_finder"""
+    config.add_request_method(get_user, 'user', reify=True)
+
+
+def has_request_user(request):
+    """True if setup_request_user added request.user to request"""
+    return hasattr(type(request), 'user')
+
+
+def group_finder(user_id, request):
+    # reified request.user is kept in the request's __dict__
+    count(None, 'drypyramid_group_finder_calls_total',
+          cache='hit' if 'user' in getattr(request, '__dict__', {})
+          else 'miss')
+    if has_request_user(request):
+        user = request.user
     else:
-        groups = ['g:{0}'.format(g.name) for g in user.groups]
-        groups.append('u:{0}'.format(user_id))
-        return groups
+        user = load_user(user_id)
+    if user is None:
+        return None
+    groups = ['g:{0}'.format(g.name) for g in user.groups]
+    groups.append('u:{0}'.format(user_id))
+    return groups
 
 
 class BaseUser(Base):
@@ -118,8 +738,22 @@ class BaseUser(Base):
                           backref=backref('users', enable_typechecks=False),
                           enable_typechecks=False)
 
+    __redacted_columns__ = ('_password',)
+
     def check_password(self, against):
-        return pwd_context.verify(against, self._password)
+        # outdated and wrapped hashes are upgraded on a successful check
+        start = time.time()
+        if is_wrapped(self._password):
+            valid = verify_wrapped(against, self._password)
+            new_hash = pwd_context.encrypt(against) if valid else None
+        else:
+            valid, new_hash = pwd_context.verify_and_update(
+                against, self._password)
+        observe(None, 'drypyramid_password_check_seconds',
+                time.time() - start)
+        if new_hash is not None:
+            self._password = new_hash
+        return valid
 
     def to_dict(self):
         data = super(BaseUser, self).to_dict()
@@ -136,7 +770,14 @@ class BaseUser(Base):
         #elif contains_password:
         #    # encrypt
         #    data['password'] = pwd_context.encrypt(data['password'])
-        super(BaseUser, self).update_from_dict(data)
+        # group order doesn't matter, compare as sets
+        group_names = data.pop('group_names', None)
+        changed = super(BaseUser, self).update_from_dict(data)
+        if group_names is not None and\
+                set(group_names) != set(self.group_names):
+            self.group_names = group_names
+            changed.add('group_names')
+        return changed
 
     @property
     def password(self):
@@ -169,6 +810,64 @@ class BaseGroup(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(100), unique=True, nullable=False)
 
+    def add_users(self, user_ids=None, criterion=None, chunk_size=1000,
+                  commit_chunks=False):
+        """Add the users with user_ids, or matching criterion, to this group
+        with chunked INSERT ... SELECTs that skip existing memberships.
+        Returns the number of added memberships"""
+        def add(ids):
+            users = BaseUser.__table__
+            member = exists().where(and_(
+                user_group.c.user_id == users.c.id,
+                user_group.c.group_id == self.id))
+            return SASession.execute(user_group.insert().from_select(
+                ['user_id', 'group_id'],
+                select([users.c.id, literal(self.id)]).where(
+                    and_(users.c.id.in_(ids), ~member)))).rowcount
+        return self.update_memberships(add, user_ids, criterion, chunk_size,
+                                       commit_chunks)
+
+    def remove_users(self, user_ids=None, criterion=None, chunk_size=1000,
+                     commit_chunks=False):
+        """Remove the users with user_ids, or matching criterion, from this
+        group with chunked DELETEs. Returns the number of removed
+        memberships"""
+        def remove(ids):
+            return SASession.execute(user_group.delete().where(and_(
+                user_group.c.group_id == self.id,
+                user_group.c.user_id.in_(ids)))).rowcount
+        return self.update_memberships(remove, user_ids, criterion,
+                                       chunk_size, commit_chunks)
+
+    def update_memberships(self, func, user_ids, criterion, chunk_size,
+                           commit_chunks):
+        if user_ids is not None:
+            user_ids = sorted(set(user_ids))
+            chunks = (user_ids[i:i + chunk_size]
+                      for i in range(0, len(user_ids), chunk_size))
+        else:
+            chunks = iter_id_chunks(BaseUser, criterion, chunk_size)
+        count = 0
+        for ids in chunks:
+            count += func(ids)
+            mark_changed(SASession())
+            self.invalidate_memberships()
+            if commit_chunks:
+                transaction.commit()
+        return count
+
+    def invalidate_memberships(self):
+        """Expire loaded users' groups so group_finder sees the new
+        memberships and bump the cached renders' user_groups version"""
+        for instance in list(SASession.identity_map.values()):
+            # don't discard pending changes to a user's groups
+            if isinstance(instance, BaseUser) and not\
+                    inspect(instance).attrs.groups.history.has_changes():
+                SASession.expire(instance, ['groups'])
+        if 'users' in inspect(self).dict:
+            SASession.expire(self, ['users'])
+        bump_table_versions([user_group.name])
+
 
 class ModelFactory(object):
     __name__ = ''
@@ -178,18 +877,120 @@ class ModelFactory(object):
     def __init__(self, request):
         self.request = request
 
+    # traversal name: relationship attribute of child collections e.g.
+    # {'hobbies': 'hobbies'} to resolve /people/1/hobbies/2
+    __children__ = {}
+
     def __getitem__(self, key):
-        try:
-            record = self.ModelClass.query().filter_by(
-                id=key).one()
-        except NoResultFound:
+        record = self.get_with_child(key)
+        if record is None and issubclass(self.ModelClass, Slugable):
+            record = self.get_by_slug(key)
+        elif record is None:
+            record = self.get_by_id(key)
+        if record is None:
             raise KeyError
-        else:
-            record.__parent__ = self
-            record.__name__ = key
-            record.request = self.request
-            self.post_get_item(record)
+        self.setup_item(record, key)
+        return record
+
+    @classmethod
+    def key_column(cls):
+        if issubclass(cls.ModelClass, Slugable):
+            return cls.ModelClass.slug_target_column()
+        return cls.ModelClass.id
+
+    def get_with_child(self, key):
+        """If the rest of the path is a child collection and a key within it,
+        load the record and the child in one joined query, the child is then
+        returned by the collection without a query of its own"""
+        traverse = self.request.matchdict.get('traverse', ()) if\
+            self.request.matchdict else ()
+        if key not in traverse:
+            return None
+        i = list(traverse).index(key)
+        path = traverse[i + 1:i + 3]
+        if len(path) < 2 or path[0] not in self.__children__:
+            return None
+        name, child_key = path
+        relation = getattr(self.ModelClass, self.__children__[name])
+        ChildClass = relation.property.mapper.class_
+        query = self.ModelClass.query().join(relation).add_entity(
+            ChildClass).filter(self.key_column() == key,
+                               ChildClass.id == child_key)
+        if issubclass(ChildClass, SoftDeletable):
+            query = query.filter(ChildClass.deleted_at == None)
+        row = query.first()
+        if row is None:
+            return None
+        record, child = row
+        record._preloaded_children = {(name, child_key): child}
+        return record
+
+    def get_child_collection(self, record, name):
+        return ChildCollection(record, name, self.__children__[name],
+                               self.request)
+
+    def setup_item(self, record, key):
+        record.__parent__ = self
+        record.__name__ = key
+        record.request = self.request
+        self.post_get_item(record)
+
+    def get_many(self, keys):
+        """Load the records for keys (ids, or slugs for Slugable models) with
+        a single IN query. Returns them in the order of keys, skipping missing
+        ones"""
+        ModelClass = self.ModelClass
+        column = self.key_column()
+        records = dict([
+            (str(getattr(record, column.key)), record) for record in
+            ModelClass.query().filter(column.in_(list(set(keys))))])
+        items = []
+        for key in keys:
+            record = records.get(key)
+            if record is not None:
+                self.setup_item(record, key)
+                items.append(record)
+        return items
+
+    def get_by_id(self, key):
+        return self.ModelClass.query().filter_by(id=key).first()
+
+    def get_by_slug(self, key):
+        """Look the record up by slug. If key is a slug the record was renamed
+        from, or its id, redirect to the current slug"""
+        ModelClass = self.ModelClass
+        slug_column = ModelClass.slug_target_column()
+        record = ModelClass.query().filter(slug_column == key).first()
+        if record is not None:
             return record
+        row = SASession.query(slug_redirect.c.record_id).filter(
+            slug_redirect.c.table_name == ModelClass.__tablename__,
+            slug_redirect.c.slug == key).first()
+        if row is not None:
+            record = self.get_by_id(row[0])
+        elif key.isdigit():
+            record = self.get_by_id(key)
+        if record is not None:
+            raise HTTPMovedPermanently(self.slug_redirect_url(key, record))
+        return None
+
+    def slug_redirect_url(self, key, record):
+        traverse = list(self.request.matchdict.get('traverse', (key,)))
+        traverse[traverse.index(key)] = self.get_record_key(record)
+        return self.request.route_url(self.__route_name__,
+                                      traverse=traverse,
+                                      _query=self.request.GET)
+
+    @classmethod
+    def get_record_key(cls, record):
+        """The traversal key for record, its slug for Slugable models. record
+        may be a row from a model_list projection"""
+        if issubclass(cls.ModelClass, Slugable):
+            slug = getattr(record, cls.ModelClass.slug_target_column().key,
+                           None)
+            if slug is not None:
+                return slug
+        return record.id
 
     def post_get_item(self, item):
         """Called after __getitem__ to manipulate the returned item e.g. attach
@@ -205,15 +1006,53 @@ class ModelFactory(object):
             self.__route_name__, traverse=('add',))
 
     def show_url(self, request, record):
-        return request.route_url(self.__route_name__, traverse=(record.id,))
+        return request.route_url(self.__route_name__,
+                                 traverse=(self.get_record_key(record),))
 
     def update_url(self, request, record):
         return request.route_url(self.__route_name__,
-                                 traverse=(record.id, 'edit'))
+                                 traverse=(self.get_record_key(record),
+                                           'edit'))
 
     def delete_url(self, request, record):
         return request.route_url(self.__route_name__,
-                                 traverse=(record.id, 'delete'))
+                                 traverse=(self.get_record_key(record),
+                                           'delete'))
+
+    @property
+    def __prettyname__(self):
+        return prettify(self.__name__)
+
+
+class ChildCollection(object):
+    """Traversal resource for a record's related records e.g. a person's
+    hobbies, register views for the child model's class on the parent's
+    route"""
+
+    def __init__(self, record, name, attribute, request):
+        self.__parent__ = record
+        self.__name__ = name
+        self.attribute = attribute
+        self.request = request
+        self.ModelClass = getattr(
+            record.__class__, attribute).property.mapper.class_
+
+    def __getitem__(self, key):
+        record = self.__parent__
+        preloaded = getattr(record, '_preloaded_children', {})
+        child = preloaded.get((self.__name__, key))
+        if child is None:
+            query = SASession.query(self.ModelClass).with_parent(
+                record, self.attribute).filter(self.ModelClass.id == key)
+            if issubclass(self.ModelClass, SoftDeletable):
+                query = query.filter(self.ModelClass.deleted_at == None)
+            child = query.first()
+        if child is None:
+            raise KeyError
+        child.__parent__ = self
+        child.__name__ = key
+        child.request = self.request
+        return child
 
     @property
     def __prettyname__(self):
@@ -0,0 +1,182 @@
+import atexit
+import logging
+import os
+import random
+import sys
+import threading
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+PROFILER_KEY = 'drypyramid.profiler'
+PROFILE_HEADER = 'X-Drypyramid-Profile'
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return u'{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+def collapse_stack(frame):
+    """Return frame's stack root first in the collapsed format understood by
+    flamegraph.pl and speedscope"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return u';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """Samples a thread's stack every interval seconds from a background
+    thread until stopped"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name='drypyramid-profiler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        return self.stacks
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+
+
+class Profiler(object):
+    """Samples requests picked at sample_rate, or sending the secret in the
+    X-Drypyramid-Profile header, and aggregates their stacks per route and
+    view into {route}.{view}.collapsed files in directory.
+
+    Only requests that matched a view are recorded, keyed on the name the
+    view was registered with. The files are rewritten every flush_interval
+    seconds from a background thread, and on stop()"""
+
+    def __init__(self, directory, sample_rate=0.0, secret=None,
+                 interval=0.005, flush_interval=5.0):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.stacks = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='drypyramid-profiler-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def run(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    def wants(self, request):
+        if self.secret is not None and\
+                request.headers.get(PROFILE_HEADER) == self.secret:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def path(self, route_name, view_name):
+        file_name = u'{0}.{1}.collapsed'.format(route_name or '_',
+                                               view_name or '_')
+        return os.path.join(self.directory, file_name.replace(os.sep, '_'))
+
+    def record(self, route_name, view_name, stacks):
+        key = (route_name, view_name)
+        with self.lock:
+            self.stacks.setdefault(key, Counter()).update(stacks)
+            self.dirty.add(key)
+
+    def flush(self):
+        """Rewrite the files of the views recorded since the last flush"""
+        with self.lock:
+            files = [(key, [u'{0} {1}\n'.format(stack, count)
+                            for stack, count in sorted(
+                                self.stacks[key].items())])
+                     for key in self.dirty]
+            self.dirty = set()
+        for (route_name, view_name), lines in files:
+            try:
+                with open(self.path(route_name, view_name), 'w') as f:
+                    f.writelines(lines)
+            except (IOError, OSError):
+                log.exception("Failed to write the profile of %s.%s",
+                              route_name, view_name)
+
+    def __call__(self, handler, request):
+        sampler = StackSampler(threading.current_thread().ident,
+                               self.interval)
+        sampler.start()
+        try:
+            return handler(request)
+        finally:
+            stacks = sampler.stop()
+            # set by profiled_view, unmatched requests are discarded
+            view = getattr(request, 'profiled_view', None)
+            if view is not None:
+                self.record(view[0], view[1], stacks)
+
+
+def profiled_view(view, info):
+    """View deriver noting the route and name a request's view was
+    registered with"""
+    if info.exception_only:
+        return view
+    key = (info.options.get('route_name'), info.options.get('name'))
+
+    def wrapper(context, request):
+        request.profiled_view = key
+        return view(context, request)
+    return wrapper
+
+
+def profiler_tween_factory(handler, registry):
+    profiler = registry[PROFILER_KEY]
+
+    def profiler_tween(request):
+        if profiler.wants(request):
+            return profiler(handler, request)
+        return handler(request)
+    return profiler_tween
+
+
+def setup_profiler(config, directory, **kwargs):
+    """Add a tween profiling selected requests, kwargs are passed to
+    Profiler. Nothing is added unless this is called"""
+    profiler = Profiler(directory, **kwargs)
+    profiler.start()
+    config.registry[PROFILER_KEY] = profiler
+    config.add_view_deriver(profiled_view, 'drypyramid_profiler')
+    config.add_tween('drypyramid.profiler.profiler_tween_factory')
+    return profiler
+
+
+def get_profiler(request):
+    return request.registry.get(PROFILER_KEY)
@@ -0,0 +1,160 @@
+import argparse
+import sys
+
+from pyramid.paster import (
+    bootstrap,
+    setup_logging,
+)
+from sqlalchemy import inspect
+
+from ..models import (
+    SASession,
+    BaseUser,
+    BaseGroup,
+    Slugable,
+    SoftDeletable,
+)
+from ..views import get_model_views
+
+
+def access_patterns(view_classes):
+    """Return (table name, columns, reason) for the lookups drypyramid makes
+    on the users and groups tables and on the models of view_classes. An
+    index whose leading columns are columns serves the lookup"""
+    models = [BaseUser, BaseGroup]
+    for view_class in view_classes:
+        ModelClass = view_class.ModelFactoryClass.ModelClass
+        if ModelClass not in models:
+            models.append(ModelClass)
+    patterns = [
+        (BaseUser.__tablename__, ('account_id',),
+         "account_id lookup in user_login"),
+        (BaseGroup.__tablename__, ('name',), "name IN (...) in group_names"),
+    ]
+    for ModelClass in models:
+        table = ModelClass.__table__
+        patterns.append((table.name, tuple(
+            c.name for c in table.primary_key.columns),
+            "traversal by id in ModelFactory"))
+        if issubclass(ModelClass, Slugable):
+            patterns.append((table.name, (
+                ModelClass.slug_target_column().name,),
+                "slug lookup in generate_slug and get_by_slug"))
+        if issubclass(ModelClass, SoftDeletable):
+            patterns.append((table.name, ('deleted_at', 'id'),
+                             "deleted_at filter in the list view"))
+        for column in ModelClass.association_columns():
+            patterns.append((column.table.name, (column.name,),
+                             "{0} memberships and delete_by_ids".format(
+                                 table.name)))
+    unique = []
+    for pattern in patterns:
+        if pattern[:2] not in [p[:2] for p in unique]:
+            unique.append(pattern)
+    return unique
+
+
+def reflect_indexes(inspector, table_name):
+    """Return [(name, columns, unique)] for the table's primary key, unique
+    constraints and indexes"""
+    indexes = []
+    primary_key = inspector.get_pk_constraint(table_name)
+    if primary_key['constrained_columns']:
+        indexes.append(('PRIMARY KEY',
+                        tuple(primary_key['constrained_columns']), True))
+    for constraint in inspector.get_unique_constraints(table_name):
+        columns = tuple(constraint['column_names'])
+        name = constraint['name'] or 'UNIQUE ({0})'.format(', '.join(columns))
+        indexes.append((name, columns, True))
+    for index in inspector.get_indexes(table_name):
+        columns = tuple(index['column_names'])
+        # unique constraints are also reported as indexes on some dialects
+        if index['unique'] and (columns, True) in [i[1:] for i in indexes]:
+            continue
+        indexes.append((index['name'], columns, bool(index['unique'])))
+    return indexes
+
+
+def advise(bind, view_classes):
+    """Compare view_classes' access patterns against the database's indexes.
+
+    Returns (missing, redundant) where missing is [(table name, columns,
+    reason)] and redundant is [(table name, index name, columns, covering
+    index name)] for non-unique indexes whose columns lead another index"""
+    inspector = inspect(bind)
+    table_names = set(inspector.get_table_names())
+    patterns = access_patterns(view_classes)
+    indexes = {}
+    for table_name in sorted(set(p[0] for p in patterns)):
+        if table_name in table_names:
+            indexes[table_name] = reflect_indexes(inspector, table_name)
+    missing = []
+    for table_name, columns, reason in patterns:
+        if table_name not in indexes:
+            continue
+        if not any(index_columns[:len(columns)] == columns
+                   for name, index_columns, unique in indexes[table_name]):
+            missing.append((table_name, columns, reason))
+    redundant = []
+    for table_name in sorted(table_names):
+        table_indexes = indexes.get(table_name)
+        if table_indexes is None:
+            table_indexes = reflect_indexes(inspector, table_name)
+        for i, (name, columns, unique) in enumerate(table_indexes):
+            if unique:
+                continue
+            for j, (other_name, other_columns, other_unique) in enumerate(
+                    table_indexes):
+                if i == j or other_columns[:len(columns)] != columns:
+                    continue
+                # of two identical indexes keep the first
+                if other_columns == columns and not other_unique and j > i:
+                    continue
+                redundant.append((table_name, name, columns, other_name))
+                break
+    return missing, redundant
+
+
+def create_index_ddl(dialect, table_name, columns):
+    quote = dialect.identifier_preparer.quote
+    name = 'ix_{0}_{1}'.format(table_name, '_'.join(columns))
+    return "CREATE INDEX {0} ON {1} ({2});".format(
+        quote(name), quote(table_name),
+        ', '.join([quote(c) for c in columns]))
+
+
+def drop_index_ddl(dialect, table_name, name):
+    quote = dialect.identifier_preparer.quote
+    if dialect.name == 'mysql':
+        return "DROP INDEX {0} ON {1};".format(quote(name), quote(table_name))
+    return "DROP INDEX {0};".format(quote(name))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Report indexes missing for, or made redundant by, the "
+                    "lookups of the registered ModelViews")
+    parser.add_argument('config_uri', help="e.g. production.ini")
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    try:
+        engine = SASession.get_bind()
+        missing, redundant = advise(
+            engine, get_model_views(env['registry']))
+        for table_name, columns, reason in missing:
+            print("Missing index on {0} ({1}) for {2}:\n    {3}".format(
+                table_name, ', '.join(columns), reason,
+                create_index_ddl(engine.dialect, table_name, columns)))
+        for table_name, name, columns, covering_name in redundant:
+            print("Redundant index {0} on {1} ({2}), covered by {3}:\n"
+                  "    {4}".format(name, table_name, ', '.join(columns),
+                                   covering_name,
+                                   drop_index_ddl(engine.dialect, table_name,
+                                                  name)))
+        if not missing and not redundant:
+            print("No missing or redundant indexes found")
+    finally:
+        env['closer']()
+    return 1 if missing else 0
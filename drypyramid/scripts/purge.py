@@ -0,0 +1,39 @@
+import argparse
+import datetime
+import sys
+
+from pyramid.paster import (
+    bootstrap,
+    setup_logging,
+)
+from pyramid.path import DottedNameResolver
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Hard delete soft deleted records in throttled batches")
+    parser.add_argument('config_uri', help="e.g. production.ini")
+    parser.add_argument('models', nargs='+',
+                        help="dotted names of SoftDeletable models e.g. "
+                             "myapp.models.Post")
+    parser.add_argument('--days', type=int, default=30,
+                        help="only purge records deleted this many days ago")
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=1.0,
+                        help="seconds to sleep between chunks")
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    try:
+        resolver = DottedNameResolver()
+        older_than = datetime.datetime.utcnow() - datetime.timedelta(
+            days=args.days)
+        for name in args.models:
+            model = resolver.resolve(name)
+            purged = model.purge_deleted(older_than,
+                                         chunk_size=args.chunk_size,
+                                         pause=args.pause)
+            print("{0}: purged {1} records".format(name, purged))
+    finally:
+        env['closer']()
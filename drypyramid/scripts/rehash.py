@@ -0,0 +1,147 @@
+import argparse
+import multiprocessing
+import sys
+from collections import defaultdict
+
+import transaction
+from pyramid.paster import (
+    bootstrap,
+    setup_logging,
+)
+from sqlalchemy import (
+    and_,
+    bindparam,
+)
+from zope.sqlalchemy import mark_changed
+
+from ..auth import (
+    pwd_context,
+    is_wrapped,
+    needs_rehash,
+    wrap_hash,
+)
+from ..models import (
+    SASession,
+    BaseUser,
+)
+
+
+def init_worker(policy):
+    pwd_context.load(policy)
+
+
+def rehash(row):
+    user_id, hash = row
+    if is_wrapped(hash):
+        return user_id, hash, None
+    return user_id, hash, wrap_hash(hash)
+
+
+def iter_user_chunks(chunk_size):
+    """Yield (id, password hash) rows in primary key order chunk_size rows at
+    a time"""
+    last_id = 0
+    while True:
+        rows = SASession.query(BaseUser.id, BaseUser._password).filter(
+            BaseUser.id > last_id).order_by(BaseUser.id).limit(
+            chunk_size).all()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+
+def scheme_name(hash):
+    if is_wrapped(hash):
+        return 'wrapped'
+    handler = pwd_context.identify(hash, resolve=True, required=False)
+    return handler.name if handler is not None else 'unknown'
+
+
+def audit_hashes(chunk_size):
+    """Return {scheme: [total, outdated]} counts"""
+    counts = defaultdict(lambda: [0, 0])
+    for rows in iter_user_chunks(chunk_size):
+        for user_id, hash in rows:
+            count = counts[scheme_name(hash)]
+            count[0] += 1
+            if needs_rehash(hash):
+                count[1] += 1
+        SASession.expunge_all()
+    return dict(counts)
+
+
+def store_hashes(params):
+    """UPDATE each user's hash from old_password to new_password, returns
+    the number of rows updated. Users whose hash changed since it was read
+    e.g. by logging in or changing password are left alone"""
+    users = BaseUser.__table__
+    update = users.update().where(and_(
+        users.c.id == bindparam('user_id'),
+        users.c._password == bindparam('old_password'))).values(
+        _password=bindparam('new_password'))
+    if SASession.get_bind().dialect.supports_sane_multi_rowcount:
+        updated = SASession.execute(update, params).rowcount
+    else:
+        updated = sum(SASession.execute(update, p).rowcount for p in params)
+    mark_changed(SASession())
+    return updated
+
+
+def rehash_passwords(chunk_size, processes):
+    """Wrap outdated hashes with the default scheme, hashing in a process
+    pool and committing after each chunk. Returns (rehashed, skipped)
+    counts, skipped hashes have no migration path or changed while being
+    rehashed"""
+    pool = multiprocessing.Pool(processes, init_worker,
+                                (pwd_context.to_string(),))
+    rehashed = skipped = 0
+    try:
+        for rows in iter_user_chunks(chunk_size):
+            outdated = [tuple(row) for row in rows if needs_rehash(row[1])]
+            params = []
+            for user_id, old_hash, new_hash in pool.imap_unordered(
+                    rehash, outdated):
+                if new_hash is None:
+                    skipped += 1
+                else:
+                    params.append({'user_id': user_id,
+                                   'old_password': old_hash,
+                                   'new_password': new_hash})
+            if params:
+                updated = store_hashes(params)
+                rehashed += updated
+                skipped += len(params) - updated
+            transaction.commit()
+    finally:
+        pool.close()
+        pool.join()
+    return rehashed, skipped
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Audit and upgrade outdated password hashes")
+    parser.add_argument('config_uri', help="e.g. production.ini")
+    parser.add_argument('--audit', action='store_true',
+                        help="only report outdated hashes")
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=None,
+                        help="defaults to the number of CPUs")
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    try:
+        if args.audit:
+            counts = audit_hashes(args.chunk_size)
+            for scheme, (total, outdated) in sorted(counts.items()):
+                print("{0}: {1} hashes, {2} outdated".format(
+                    scheme, total, outdated))
+        else:
+            rehashed, skipped = rehash_passwords(args.chunk_size,
+                                                 args.processes)
+            print("Rehashed {0} passwords, skipped {1} with no migration "
+                  "path or that changed meanwhile".format(rehashed, skipped))
+    finally:
+        env['closer']()
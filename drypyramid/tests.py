@@ -1,21 +1,38 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import colander
+import transaction
 
 from webob.multidict import MultiDict
+from deform import ValidationFailure
 from webtest import TestApp
 from pyramid import testing
+from pyramid.events import BeforeRender
+from pyramid.response import Response
+from pyramid.request import apply_request_extensions
+from pyramid.security import Allow, Deny, Everyone
+from pyramid.authentication import AuthTktAuthenticationPolicy
+from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.httpexceptions import (
     HTTPNotFound,
-    HTTPFound
+    HTTPFound,
+    HTTPMovedPermanently,
 )
 from sqlalchemy import (
-    create_engine,
+    event,
     Column,
     Integer,
     String,
     Table,
     ForeignKey,
 )
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import (
     relationship,
 )
@@ -25,15 +42,90 @@ from .models import (
     ModelFactory,
     BaseRootFactory,
     BaseUser,
+    BaseGroup,
+    user_group,
+    change_log,
+    insert_ignore,
+    Versioned,
+    SoftDeletable,
+    ChangeTracked,
+    Slugable,
+    set_slug,
+    record_slug_change,
+    group_finder,
+    setup_request_user,
+    request_scope,
+    set_session_scopefunc,
+    setup_request_session,
+)
+from .auth import (
+    pwd_context,
+    is_wrapped,
+    wrap_hash,
+    verify_wrapped,
+)
+from .scripts.rehash import (
+    audit_hashes,
+    rehash_passwords,
+    store_hashes,
+)
+from .scripts.indexes import (
+    advise,
+    create_index_ddl,
+)
+from .audit import (
+    AuditLog,
+    audit_record,
+    dict_diff,
+    request_user_id,
+    FileAuditSink,
+    AUDIT_LOG_KEY,
+)
+from .throttle import (
+    MemoryThrottleStore,
+    setup_login_throttle,
+)
+from .limits import (
+    StatementTimeout,
+    TooManyQueries,
+    TooManyRows,
+    add_max_execution_time,
+    limit_queries,
+    limit_traversal_queries,
+    setup_query_limits,
+)
+from .profiler import Profiler, setup_profiler
+from .fixtures import (
+    DatabaseTestCase,
+    seed,
+)
+from .metrics import (
+    Metrics,
+    setup_metrics,
+)
+from .cache import (
+    MemoryRenderCache,
+    MemoryVersionStore,
+    set_cache_backends,
+)
+from .forms import (
+    BaseUserUpdateForm,
+    FormCache,
+    VersionedForm,
 )
-from .auth import pwd_context
 from .views import (
     model_list,
     model_create,
     model_show,
     model_update,
     model_delete,
+    model_bulk_delete,
+    model_changes,
+    model_batch_show,
+    record_json,
     ModelView,
+    include_model_views,
+    get_model_views,
 )
 
 
@@ -58,6 +150,58 @@ class Hobby(Base):
     name = Column(String(100), unique=True, nullable=False)
 
 
+class Note(Versioned, Base):
+    __tablename__ = 'note'
+    id = Column(Integer, primary_key=True)
+    title = Column(String(100), nullable=False)
+
+
+class Post(SoftDeletable, Base):
+    __tablename__ = 'post'
+    id = Column(Integer, primary_key=True)
+    title = Column(String(100), nullable=False)
+
+
+class PostModelFactory(ModelFactory):
+    ModelClass = Post
+
+
+class Article(Slugable, Base):
+    __tablename__ = 'article'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False)
+    slug = Column(String(100), unique=True, nullable=False)
+
+    def slug_unique_query(self):
+        return Article.query()
+
+
+event.listen(Article, 'before_insert', set_slug)
+event.listen(Article, 'before_update', record_slug_change)
+
+
+class ArticleModelFactory(ModelFactory):
+    ModelClass = Article
+
+
+class Tag(ChangeTracked, Base):
+    __tablename__ = 'tag'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False)
+
+
+class Memo(SoftDeletable, ChangeTracked, Base):
+    __tablename__ = 'memo'
+    id = Column(Integer, primary_key=True)
+    title = Column(String(100), nullable=False)
+
+
+class Release(Base):
+    __tablename__ = 'release'
+    id = Column(Integer, primary_key=True)
+    version = Column(String(20), nullable=False)
+
+
 class PersonModelFactory(ModelFactory):
     ModelClass = Person
 
@@ -65,11 +209,27 @@ class PersonModelFactory(ModelFactory):
         self.post_get_item_called = True
 
 
+class HobbyModelFactory(ModelFactory):
+    ModelClass = Hobby
+
+
 class PersonForm(colander.MappingSchema):
     name = colander.SchemaNode(colander.String(encoding='utf-8'))
     age = colander.SchemaNode(colander.Integer())
 
 
+class HobbyForm(colander.MappingSchema):
+    name = colander.SchemaNode(colander.String(encoding='utf-8'))
+
+
+class NoteForm(VersionedForm):
+    title = colander.SchemaNode(colander.String(encoding='utf-8'))
+
+
+class ReleaseForm(colander.MappingSchema):
+    version = colander.SchemaNode(colander.String(encoding='utf-8'))
+
+
 class HobbiesSchema(colander.SequenceSchema):
     name = colander.SchemaNode(
         colander.String(encoding='utf-8'), title="Hobby")
@@ -83,21 +243,8 @@ class PersonUpdateForm(colander.MappingSchema):
     ])
 
 
-class TestBase(unittest.TestCase):
-    def _setup_db(self):
-        self.engine = create_engine('sqlite:///:memory:', echo=True)
-        SASession.configure(bind=self.engine)
-        Base.metadata.create_all(self.engine)
-
-    def setUp(self):
-        self.config = testing.setUp()
-        #self.config.add_route('login', '/login')
-        #self.config.add_route('root', '/*traverse')
-        self._setup_db()
-
-    def tearDown(self):
-        SASession.remove()
-        testing.tearDown()
+class TestBase(DatabaseTestCase):
+    pass
 
 
 class TestBaseModel(TestBase):
@@ -130,10 +277,400 @@ class TestBaseModel(TestBase):
         self.assertEqual(model.name, update_data['name'])
         self.assertEqual(model.age, update_data['age'])
 
+    def test_update_from_dict_returns_changed_keys(self):
+        model = Person(name="Mr Smith", age=23)
+        changed = model.update_from_dict({'name': "Mr Smith", 'age': 35})
+        self.assertEqual(changed, set(['age']))
+
+    def test_update_from_dict_coerces_values_before_comparing(self):
+        model = Person(name="Mr Smith", age=23)
+        changed = model.update_from_dict({'age': '23'})
+        self.assertEqual(changed, set())
+        self.assertEqual(model.age, 23)
+
+    def test_update_from_dict_parses_booleans(self):
+        user = BaseUser(account_id='admin@example.com', is_active=True)
+        self.assertEqual(user.update_from_dict({'is_active': 'false'}),
+                         set(['is_active']))
+        self.assertIs(user.is_active, False)
+        self.assertEqual(user.update_from_dict({'is_active': '0'}), set())
+        user.update_from_dict({'is_active': 'true'})
+        self.assertIs(user.is_active, True)
+
+    def test_delete_by_ids_deletes_association_rows(self):
+        group = BaseGroup(name='su')
+        user = BaseUser(account_id='admin@example.com', _password='admin',
+                        groups=[group])
+        user.save()
+        SASession.flush()
+        user_id = user.id
+        SASession.expunge_all()
+
+        self.assertEqual(BaseUser.delete_by_ids([user_id]), 1)
+        self.assertEqual(BaseUser.query().count(), 0)
+        self.assertEqual(
+            SASession.execute(user_group.select()).fetchall(), [])
+        self.assertEqual(BaseGroup.query().count(), 1)
+
+    def test_delete_where_deletes_in_chunks(self):
+        for i in range(5):
+            Person(name='Person {0}'.format(i), age=20 + i).save()
+        SASession.flush()
+        deleted = Person.delete_where(Person.age < 24, chunk_size=2,
+                                      max_chunks=1)
+        self.assertEqual(deleted, 2)
+        deleted = Person.delete_where(Person.age < 24, chunk_size=2)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(Person.query().count(), 1)
+
+    def test_mysql_insert_ignore_only_ignores_duplicate_keys(self):
+        statement = str(insert_ignore(Person.__table__, mysql.dialect())
+                        .compile(dialect=mysql.dialect()))
+        self.assertNotIn('IGNORE', statement)
+        self.assertTrue(statement.endswith(
+            'ON DUPLICATE KEY UPDATE id = person.id'))
+
+    def test_bulk_insert_or_ignore_skips_duplicates(self):
+        Person(name='Mr Smith', age=30).save()
+        SASession.flush()
+        inserted = Person.bulk_insert_or_ignore([
+            {'name': 'Mr Smith', 'age': 31},
+            {'name': 'Mrs Smith', 'age': 32}])
+        self.assertEqual(inserted, 1)
+        self.assertEqual(Person.query().count(), 2)
+
+    def test_insert_or_ignore_sets_version(self):
+        note = Note(title='Draft')
+        self.assertTrue(note.insert_or_ignore())
+        self.assertEqual(note.version, 1)
+        note.title = 'Final'
+        SASession.flush()
+        self.assertEqual(note.version, 2)
+
+    def test_insert_or_ignore_flushes_records_with_relationships(self):
+        BaseGroup(name='su').save()
+        SASession.flush()
+        for expected in (True, False):
+            user = BaseUser(account_id='admin@example.com', _password='hash')
+            user.group_names = ['su']
+            self.assertEqual(user.insert_or_ignore(), expected)
+        SASession.flush()
+        user = BaseUser.query().one()
+        self.assertEqual(user.group_names, ['su'])
+
+    def test_insert_or_ignore_runs_insert_listeners(self):
+        for expected in (True, True):
+            self.assertEqual(Article(name='Hello').insert_or_ignore(),
+                             expected)
+        self.assertEqual(sorted(a.slug for a in Article.query()),
+                         ['hello', 'hello-1'])
+
+    def test_insert_or_ignore_only_ignores_unique_violations(self):
+        self.assertRaises(IntegrityError, Person(name='Mr Smith').
+                          insert_or_ignore)
+        self.assertRaises(ValueError, Person.bulk_insert_or_ignore,
+                          [{'name': 'Mr Smith'}])
+
     def test_to_dict_handles_relationships(self):
         pass
 
 
+class TestFormCache(unittest.TestCase):
+    def test_get_form_reuses_bound_schema(self):
+        cache = FormCache()
+        form1 = cache.get_form(PersonForm)
+        form2 = cache.get_form(PersonForm)
+        self.assertIsNot(form1, form2)
+        self.assertIs(form1.schema, form2.schema)
+
+    def test_schema_without_deferreds_is_shared_across_records(self):
+        cache = FormCache()
+        cache.get_form(BaseUserUpdateForm, {'pk': None})
+        form1 = cache.get_form(BaseUserUpdateForm, {'pk': 1})
+        form2 = cache.get_form(BaseUserUpdateForm, {'pk': 2})
+        self.assertIs(form1.children[0].schema, form2.children[0].schema)
+        self.assertEqual(len(cache.prototypes), 1)
+
+    def test_validators_can_read_bindings(self):
+        class RecordForm(colander.MappingSchema):
+            name = colander.SchemaNode(colander.String())
+
+            def validator(self, node, value):
+                # e.g. a uniqueness check skipping the edited record
+                if value['name'] == 'taken' and self.bindings['pk'] != 1:
+                    raise colander.Invalid(node, "Name is taken")
+
+        cache = FormCache()
+        form = cache.get_form(RecordForm, {'pk': 1})
+        self.assertEqual(form.validate([('name', 'taken')]),
+                         {'name': 'taken'})
+        form = cache.get_form(RecordForm, {'pk': 2})
+        self.assertRaises(ValidationFailure, form.validate,
+                          [('name', 'taken')])
+        self.assertEqual(len(cache.prototypes), 1)
+
+    def test_schema_with_deferreds_is_bound_per_record(self):
+        @colander.deferred
+        def deferred_title(node, kw):
+            return 'Name of {0}'.format(kw['pk'])
+
+        class RecordForm(colander.MappingSchema):
+            name = colander.SchemaNode(colander.String(),
+                                       title=deferred_title)
+
+        cache = FormCache()
+        form1 = cache.get_form(RecordForm, {'pk': 1})
+        form2 = cache.get_form(RecordForm, {'pk': 2})
+        self.assertEqual(form1['name'].title, 'Name of 1')
+        self.assertEqual(form2['name'].title, 'Name of 2')
+        self.assertEqual(len(cache.prototypes), 0)
+
+    def test_field_state_does_not_leak_between_clones(self):
+        cache = FormCache()
+        form = cache.get_form(PersonForm, appstruct={'name': 'Mr Smith',
+                                                    'age': 23})
+        self.assertEqual(form['age'].cstruct, '23')
+        self.assertRaises(ValidationFailure, form.validate, [('age', 'abc')])
+        form = cache.get_form(PersonForm)
+        self.assertEqual(form['age'].cstruct, colander.null)
+        self.assertIsNone(form.error)
+        self.assertIsNone(form['age'].error)
+
+    def test_cache_is_bounded(self):
+        cache = FormCache(max_size=1)
+        cache.get_form(PersonForm)
+        cache.get_form(HobbyForm)
+        self.assertEqual(len(cache.prototypes), 1)
+
+
+class TestRequestSession(TestBase):
+    def tearDown(self):
+        set_session_scopefunc(None)
+        super(TestRequestSession, self).tearDown()
+
+    def test_sessions_are_scoped_per_request(self):
+        set_session_scopefunc(request_scope)
+        request1 = testing.DummyRequest()
+        request2 = testing.DummyRequest()
+        self.config.begin(request=request1)
+        session1 = SASession()
+        self.config.end()
+        self.config.begin(request=request2)
+        session2 = SASession()
+        self.config.end()
+        self.assertIsNot(session1, session2)
+
+    def test_request_dbsession_is_removed_when_request_finishes(self):
+        sessions = []
+
+        def view(request):
+            person = Person(name='Mr Smith', age=23)
+            person.save()
+            sessions.append((request.dbsession, SASession()))
+            return {}
+
+        setup_request_session(self.config)
+        self.config.add_route('people', '/people')
+        self.config.add_view(view, route_name='people', renderer='json')
+        testapp = TestApp(self.config.make_wsgi_app())
+        testapp.get('/people')
+        testapp.get('/people')
+        (dbsession1, session1), (dbsession2, session2) = sessions
+        self.assertIs(dbsession1, session1)
+        self.assertIsNot(session1, session2)
+        self.assertEqual(SASession.registry.registry, {})
+
+
+class TestSoftDeletable(TestBase):
+    def setUp(self):
+        super(TestSoftDeletable, self).setUp()
+        self.post = Post(title='Hello')
+        self.post.save()
+        SASession.flush()
+
+    def test_delete_marks_record_as_deleted(self):
+        self.post.delete()
+        SASession.flush()
+        self.assertTrue(self.post.is_deleted)
+        self.assertEqual(Post.query().count(), 0)
+        self.assertEqual(Post.query_with_deleted().count(), 1)
+
+    def test_factory_does_not_find_deleted_records(self):
+        self.post.delete()
+        SASession.flush()
+        factory = PostModelFactory(testing.DummyRequest())
+        self.assertRaises(KeyError, factory.__getitem__, self.post.id)
+
+    def test_purge_deleted(self):
+        Post(title='Still here').save()
+        Post(title='Deleted later',
+             deleted_at=datetime.datetime(2013, 9, 1)).save()
+        self.post.deleted_at = datetime.datetime(2013, 8, 1)
+        SASession.flush()
+        purged = Post.purge_deleted(datetime.datetime(2013, 8, 15),
+                                    chunk_size=1)
+        self.assertEqual(purged, 1)
+        self.assertEqual(Post.query_with_deleted().count(), 2)
+
+
+class TestRequestUser(TestBase):
+    def setUp(self):
+        super(TestRequestUser, self).setUp()
+        self.config.testing_securitypolicy(userid='1')
+        setup_request_user(self.config)
+        group = BaseGroup(name='su')
+        self.user = BaseUser(account_id='admin@example.com',
+                             _password='admin', is_active=True,
+                             groups=[group])
+        self.user.save()
+        SASession.flush()
+        SASession.expunge_all()
+
+    def _make_request(self):
+        request = testing.DummyRequest()
+        apply_request_extensions(request)
+        return request
+
+    def test_group_finder_uses_request_user(self):
+        request = self._make_request()
+        self.assertEqual(request.user.id, self.user.id)
+        self.assertIn('groups', request.user.__dict__)
+        self.assertEqual(group_finder('1', request), ['g:su', 'u:1'])
+
+    def test_inactive_users_are_rejected(self):
+        BaseUser.query().update({'is_active': False})
+        request = self._make_request()
+        self.assertIsNone(request.user)
+        self.assertIsNone(group_finder('1', request))
+
+    def test_group_finder_without_request_user(self):
+        self.assertEqual(group_finder('1', object()), ['g:su', 'u:1'])
+
+    def test_group_finder_does_not_hide_request_user_errors(self):
+        def broken_user(request):
+            raise AttributeError('broken')
+        self.config.add_request_method(broken_user, 'user', reify=True)
+        self.assertRaises(AttributeError, group_finder, '1',
+                          self._make_request())
+
+    def test_audit_entries_use_request_user(self):
+        request = self._make_request()
+        self.assertEqual(request_user_id(request), self.user.id)
+
+
+class TestChangeFeed(TestBase):
+    def setUp(self):
+        super(TestChangeFeed, self).setUp()
+        self.tags = [Tag(name='tag{0}'.format(i)) for i in range(3)]
+        for tag in self.tags:
+            tag.save()
+        SASession.flush()
+
+    def test_changes_since_returns_latest_change_per_record(self):
+        self.tags[0].name = 'renamed'
+        SASession.flush()
+        changes, has_more = Tag.changes_since(0)
+        self.assertFalse(has_more)
+        self.assertEqual([(seq, record_id) for seq, record_id, r in changes],
+                         [(2, 2), (3, 3), (4, 1)])
+        self.assertEqual(changes[-1][2].name, 'renamed')
+
+    def test_deletes_are_tombstones(self):
+        self.tags[1].delete()
+        SASession.flush()
+        Tag.delete_by_ids([self.tags[2].id])
+        changes, has_more = Tag.changes_since(3)
+        self.assertEqual(changes, [(4, 2, None), (5, 3, None)])
+
+    def test_soft_deletes_and_purges_log_one_tombstone(self):
+        memo = Memo(title='Memo')
+        memo.save()
+        SASession.flush()
+        Memo.soft_delete_by_ids([memo.id])
+        Memo.soft_delete_by_ids([memo.id])
+        Memo.purge_deleted(datetime.datetime.utcnow() +
+                           datetime.timedelta(days=1))
+        self.assertEqual(Memo.query_with_deleted().count(), 0)
+        operations = [row.operation for row in SASession.query(
+            change_log).filter(change_log.c.table_name == 'memo')]
+        self.assertEqual(operations, ['insert', 'delete'])
+
+    def test_model_changes_paginates(self):
+        view = model_changes(Tag, page_size=2)
+        request = testing.DummyRequest()
+        response = view(None, request)
+        self.assertEqual(response['cursor'], 2)
+        self.assertTrue(response['has_more'])
+        self.assertEqual(response['changes'][0]['record']['name'], 'tag0')
+        request = testing.DummyRequest(params={'cursor': '2'})
+        response = view(None, request)
+        self.assertEqual(response['cursor'], 3)
+        self.assertFalse(response['has_more'])
+
+    def test_model_changes_clamps_limit(self):
+        request = testing.DummyRequest(params={'limit': '0'})
+        response = model_changes(Tag)(None, request)
+        self.assertEqual(len(response['changes']), 1)
+        self.assertTrue(response['has_more'])
+
+    def test_changes_wait_for_lag(self):
+        self.assertEqual(Tag.changes_since(0, lag=60), ([], False))
+        SASession.execute(change_log.update().values(
+            logged_at=datetime.datetime.utcnow() -
+            datetime.timedelta(seconds=61)).where(change_log.c.seq == 1))
+        changes, has_more = Tag.changes_since(0, lag=60)
+        self.assertEqual([seq for seq, record_id, r in changes], [1])
+
+    def test_record_json_redacts_and_converts_values(self):
+        user = BaseUser(account_id='admin@example.com', _password='secret')
+        user.save()
+        post = Post(title='Hello')
+        post.save()
+        post.delete()
+        SASession.flush()
+        self.assertNotIn('_password', record_json(user))
+        self.assertEqual(record_json(post)['deleted_at'],
+                         post.deleted_at.isoformat())
+
+
+class TestGroupMemberships(TestBase):
+    def setUp(self):
+        super(TestGroupMemberships, self).setUp()
+        self.group = BaseGroup(name='su')
+        self.group.save()
+        self.users = [BaseUser(account_id='user{0}@example.com'.format(i),
+                               _password='x', is_active=i % 2 == 0)
+                      for i in range(5)]
+        for user in self.users:
+            user.save()
+        self.users[0].groups = [self.group]
+        SASession.flush()
+
+    def test_add_users_skips_existing_memberships(self):
+        added = self.group.add_users(
+            user_ids=[u.id for u in self.users[:3]], chunk_size=2)
+        self.assertEqual(added, 2)
+        self.assertEqual(self.users[1].group_names, ['su'])
+        self.assertEqual(len(self.group.users), 3)
+
+    def test_add_users_by_criterion(self):
+        added = self.group.add_users(criterion=BaseUser.is_active == True,
+                                     chunk_size=1)
+        self.assertEqual(added, 2)
+        self.assertEqual(
+            sorted([u.account_id for u in self.group.users]),
+            ['user0@example.com', 'user2@example.com',
+             'user4@example.com'])
+
+    def test_remove_users(self):
+        self.group.add_users(user_ids=[u.id for u in self.users])
+        removed = self.group.remove_users(
+            criterion=BaseUser.is_active == False)
+        self.assertEqual(removed, 2)
+        self.assertEqual(self.users[1].group_names, [])
+        self.assertEqual(self.users[0].group_names, ['su'])
+
+
 class TestModelFactory(TestBase):
     def setUp(self):
         super(TestModelFactory, self).setUp()
@@ -187,6 +724,103 @@ class TestModelFactory(TestBase):
         self.assertTrue(self.factory.post_get_item_called)
 
 
+class TestSlugTraversal(TestBase):
+    def setUp(self):
+        super(TestSlugTraversal, self).setUp()
+        self.request = testing.DummyRequest()
+        self.config.add_route('articles', '/articles/*traverse',
+                              factory=ArticleModelFactory)
+        ArticleModelFactory.__route_name__ = 'articles'
+        self.factory = ArticleModelFactory(self.request)
+        self.article = Article(name='Hello World')
+        self.article.save()
+        SASession.flush()
+
+    def test_get_item_by_slug(self):
+        record = self.factory['hello-world']
+        self.assertIs(record, self.article)
+        self.assertRaises(KeyError, self.factory.__getitem__, 'unknown')
+
+    def test_url_helpers_use_slug(self):
+        url = self.factory.update_url(self.request, self.article)
+        self.assertEqual(url, '{0}/articles/hello-world/edit'.format(
+            self.request.application_url))
+
+    def test_old_slugs_redirect(self):
+        self.article.slug = 'hello-again'
+        SASession.flush()
+        self.request.matchdict = {'traverse': ('hello-world', 'edit')}
+        try:
+            self.factory['hello-world']
+        except HTTPMovedPermanently as e:
+            self.assertEqual(e.location,
+                             '{0}/articles/hello-again/edit'.format(
+                                 self.request.application_url))
+        else:
+            self.fail("HTTPMovedPermanently not raised")
+
+    def test_ids_redirect_to_slug(self):
+        key = str(self.article.id)
+        self.request.matchdict = {'traverse': (key,)}
+        try:
+            self.factory[key]
+        except HTTPMovedPermanently as e:
+            self.assertEqual(e.location, '{0}/articles/hello-world'.format(
+                self.request.application_url))
+        else:
+            self.fail("HTTPMovedPermanently not raised")
+
+    def test_list_projection_rows_use_slug(self):
+        records = model_list(Article, columns=('name',))(
+            self.request)['records']
+        self.assertEqual(self.factory.show_url(self.request, records[0]),
+                         '{0}/articles/hello-world'.format(
+                             self.request.application_url))
+
+
+class TestChildTraversal(TestBase):
+    class PersonHobbiesFactory(ModelFactory):
+        ModelClass = Person
+        __children__ = {'hobbies': 'hobbies'}
+
+    def setUp(self):
+        super(TestChildTraversal, self).setUp()
+        self.golf = Hobby(name='Golf')
+        Person(name='Mr Smith', age=23, hobbies=[self.golf]).save()
+        Hobby(name='Chess').save()
+        SASession.flush()
+        SASession.expunge_all()
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._count_statement)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute',
+                        self._count_statement)
+
+    def _count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_child_is_loaded_with_parent_in_one_query(self):
+        request = testing.DummyRequest()
+        request.matchdict = {'traverse': ('1', 'hobbies', '1', 'edit')}
+        factory = self.PersonHobbiesFactory(request)
+        hobby = factory['1']['hobbies']['1']
+        self.assertEqual(hobby.name, 'Golf')
+        self.assertEqual(hobby.__parent__.__parent__.name, 'Mr Smith')
+        self.assertEqual(len(self.statements), 1)
+
+    def test_child_outside_collection_is_not_found(self):
+        request = testing.DummyRequest()
+        request.matchdict = {'traverse': ('1', 'hobbies', '2')}
+        factory = self.PersonHobbiesFactory(request)
+        hobbies = factory['1']['hobbies']
+        self.assertRaises(KeyError, hobbies.__getitem__, '2')
+
+    def test_undeclared_children_are_not_traversable(self):
+        request = testing.DummyRequest()
+        factory = self.PersonHobbiesFactory(request)
+        self.assertRaises(KeyError, factory['1'].__getitem__, 'edit')
+
+
 class TestViewHelpers(TestBase):
     def setUp(self):
         super(TestViewHelpers, self).setUp()
@@ -204,6 +838,23 @@ class TestViewHelpers(TestBase):
         self.assertIn('records', response)
         self.assertIsInstance(response['records'][0], Person)
 
+    def test_model_list_with_columns_returns_rows(self):
+        person = Person(name='Mr Smith', age=23)
+        person.save()
+        SASession.flush()
+
+        view = model_list(Person, ('name',))
+        request = testing.DummyRequest()
+        response = view(request)
+        record = response['records'][0]
+        self.assertNotIsInstance(record, Person)
+        self.assertEqual(record.id, person.id)
+        self.assertEqual(record.name, 'Mr Smith')
+        self.assertFalse(hasattr(record, 'age'))
+        factory = PersonModelFactory(request)
+        self.assertEqual(factory.show_url(request, record),
+                         '{0}/persons/1'.format(request.application_url))
+
     def test_model_create(self):
         def _post_create_response_callback(request, record):
             return HTTPFound(request.route_url('persons',
@@ -230,6 +881,35 @@ class TestViewHelpers(TestBase):
         person = Person.query().filter_by(name='Mr Smith').one()
         self.assertEqual(person.age, 25)
 
+    def test_model_create_ignoring_duplicates(self):
+        def _post_create_response_callback(request, record):
+            return HTTPFound(request.route_url('persons',
+                                               traverse=(record.id,)))
+
+        Person(name='Mr Smith', age=30).save()
+        SASession.flush()
+
+        view = model_create(Person, PersonForm, _post_create_response_callback,
+                            ignore_duplicates=True)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([
+            ('csrf_token', request.session.get_csrf_token()),
+            ('name', 'Mr Smith'),
+            ('age', '22')])
+        response = view(PersonModelFactory(request), request)
+        self.assertIn('form', response)
+        self.assertEqual(request.session.peek_flash('error'),
+                         [u"A duplicate record exists."])
+
+        request.POST['name'] = 'Mrs Smith'
+        response = view(PersonModelFactory(request), request)
+        self.assertIsInstance(response, HTTPFound)
+        self.assertEqual(response.location,
+                         '{0}/persons/2'.format(request.application_url))
+        person = Person.query().filter_by(name='Mrs Smith').one()
+        self.assertEqual(person.age, 22)
+
     def test_model_show(self):
         person = Person(name='Mr Smith', age=23)
         person.save()
@@ -270,6 +950,117 @@ class TestViewHelpers(TestBase):
         person = Person.query().filter_by(name='Mr Smith').one()
         self.assertEqual(person.age, 28)
 
+    def test_model_update_skips_save_when_nothing_changed(self):
+        def _post_update_response_callback(request, record):
+            return HTTPFound(request.route_url('persons',
+                                               traverse=(record.id,)))
+
+        person = Person(name='Mr Smith', age=23)
+        person.save()
+        SASession.flush()
+
+        view = model_update(Person, PersonForm, _post_update_response_callback)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        values = [
+            ('csrf_token', request.session.get_csrf_token()),
+            ('name', 'Mr Smith'),
+            ('age', '23'),
+        ]
+        request.POST = MultiDict(values)
+        response = view(person, request)
+        self.assertIsInstance(response, HTTPFound)
+        self.assertFalse(SASession.is_modified(person))
+        self.assertEqual(request.session.peek_flash('info'),
+                         [u"No changes were made."])
+
+    def test_model_update_saves_unversioned_version_column(self):
+        release = Release(version='1.0')
+        release.save()
+        SASession.flush()
+
+        view = model_update(Release, ReleaseForm,
+                            lambda request, record: HTTPFound('/'))
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([
+            ('csrf_token', request.session.get_csrf_token()),
+            ('version', '2.0'),
+        ])
+        view(release, request)
+        self.assertEqual(release.version, '2.0')
+        self.assertEqual(request.session.peek_flash('success'),
+                         [u"Your changes have been saved."])
+
+    def test_model_update_rejects_stale_version(self):
+        note = Note(title='Draft')
+        note.save()
+        SASession.flush()
+        note.title = 'Published'
+        SASession.flush()
+        self.assertEqual(note.version, 2)
+
+        view = model_update(Note, NoteForm, None)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        values = [
+            ('csrf_token', request.session.get_csrf_token()),
+            ('title', 'Final'),
+            ('version', '1'),
+        ]
+        request.POST = MultiDict(values)
+        response = view(note, request)
+        self.assertEqual(request.response.status_code, 409)
+        self.assertIn('form', response)
+        self.assertEqual(note.title, 'Published')
+
+    def test_model_update_increments_version(self):
+        def _post_update_response_callback(request, record):
+            return HTTPFound(request.route_url('persons',
+                                               traverse=(record.id,)))
+
+        note = Note(title='Draft')
+        note.save()
+        SASession.flush()
+
+        view = model_update(Note, NoteForm, _post_update_response_callback)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        values = [
+            ('csrf_token', request.session.get_csrf_token()),
+            ('title', 'Final'),
+            ('version', '1'),
+        ]
+        request.POST = MultiDict(values)
+        response = view(note, request)
+        self.assertIsInstance(response, HTTPFound)
+        self.assertEqual(note.title, 'Final')
+        self.assertEqual(note.version, 2)
+
+    def test_model_batch_show(self):
+        class PersonACLFactory(PersonModelFactory):
+            __acl__ = [(Allow, Everyone, 'view')]
+
+            def post_get_item(self, item):
+                if item.name == 'Secret':
+                    item.__acl__ = [(Deny, Everyone, 'view')]
+
+        self.config.set_authorization_policy(ACLAuthorizationPolicy())
+        self.config.set_authentication_policy(
+            AuthTktAuthenticationPolicy('secret'))
+        for name in ('Mr Smith', 'Secret', 'Mrs Smith'):
+            Person(name=name, age=30).save()
+        SASession.flush()
+        view = model_batch_show('view')
+        request = testing.DummyRequest(params={'ids': '3,2,1,9'})
+        response = view(PersonACLFactory(request), request)
+        self.assertEqual([r['name'] for r in response['records']],
+                         ['Mrs Smith', 'Mr Smith'])
+        request = testing.DummyRequest(params={'ids': '3,1,3,1'})
+        response = view(PersonACLFactory(request), request)
+        self.assertEqual([r['name'] for r in response['records']],
+                         ['Mrs Smith', 'Mr Smith'])
+
     def test_model_delete(self):
         def _post_del_response_callback(request, record):
             return HTTPFound(request.route_url('persons', traverse=()))
@@ -291,6 +1082,177 @@ class TestViewHelpers(TestBase):
         self.assertEqual(response.location,
                               '{0}/persons/'.format(request.application_url))
 
+    def test_model_delete_direct(self):
+        def _post_del_response_callback(request, record):
+            return HTTPFound(request.route_url('persons', traverse=()))
+
+        person = Person(name='Mr Smith', age=23, hobbies=[Hobby(name='Golf')])
+        person.save()
+        SASession.flush()
+        view = model_delete(_post_del_response_callback, direct=True)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        response = view(person, request)
+        self.assertIsInstance(response, HTTPFound)
+        self.assertEqual(Person.query().count(), 0)
+        self.assertEqual(Hobby.query().count(), 1)
+
+    def test_model_bulk_delete(self):
+        for i in range(3):
+            Person(name='Person {0}'.format(i), age=30).save()
+        Person(name='Mr Smith', age=23).save()
+        SASession.flush()
+        view = model_bulk_delete(Person, chunk_size=2)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([
+            ('csrf_token', request.session.get_csrf_token()),
+            ('age', '30')])
+        response = view(PersonModelFactory(request), request)
+        self.assertEqual(response, {'deleted': 2, 'remaining': True})
+        response = view(PersonModelFactory(request), request)
+        self.assertEqual(response, {'deleted': 1, 'remaining': False})
+        self.assertEqual(Person.query().count(), 1)
+
+    def test_model_bulk_delete_soft_deletes(self):
+        deleted = Post(title='Old', deleted_at=datetime.datetime(2013, 1, 1))
+        deleted.save()
+        for i in range(3):
+            Post(title='Old').save()
+        SASession.flush()
+        view = model_bulk_delete(Post, chunk_size=2)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([
+            ('csrf_token', request.session.get_csrf_token()),
+            ('title', 'Old')])
+        response = view(PostModelFactory(request), request)
+        self.assertEqual(response, {'deleted': 2, 'remaining': True})
+        response = view(PostModelFactory(request), request)
+        self.assertEqual(response, {'deleted': 1, 'remaining': False})
+        SASession.expire_all()
+        self.assertEqual(Post.query().count(), 0)
+        self.assertEqual(Post.query_with_deleted().count(), 4)
+        self.assertEqual(deleted.deleted_at, datetime.datetime(2013, 1, 1))
+
+    def test_model_bulk_delete_filters_on_booleans(self):
+        for i in range(3):
+            BaseUser(account_id='user{0}@example.com'.format(i),
+                     _password='x', is_active=i < 2).save()
+        SASession.flush()
+        view = model_bulk_delete(BaseUser)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([
+            ('csrf_token', request.session.get_csrf_token()),
+            ('is_active', 'false')])
+        response = view(None, request)
+        self.assertEqual(response, {'deleted': 1, 'remaining': False})
+        self.assertEqual([u.is_active for u in BaseUser.query()],
+                         [True, True])
+        request.POST['is_active'] = 'no'
+        response = view(None, request)
+        self.assertEqual(response.status_code, 400)
+
+    def test_model_bulk_delete_requires_a_filter(self):
+        view = model_bulk_delete(Person)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([
+            ('csrf_token', request.session.get_csrf_token())])
+        response = view(PersonModelFactory(request), request)
+        self.assertEqual(response.status_code, 400)
+
+
+class ListAuditSink(object):
+    def __init__(self):
+        self.batches = []
+
+    def write(self, entries):
+        self.batches.append(entries)
+
+
+class TestAuditLog(TestBase):
+    def setUp(self):
+        super(TestAuditLog, self).setUp()
+        self.sink = ListAuditSink()
+        self.audit_log = AuditLog(self.sink, batch_size=2)
+        self.config.registry[AUDIT_LOG_KEY] = self.audit_log
+
+    def test_entries_are_buffered_until_commit(self):
+        request = testing.DummyRequest()
+        self.audit_log.record(request, 'create', 'person', 1, {})
+        self.audit_log.flush()
+        self.assertEqual(self.sink.batches, [])
+        transaction.commit()
+        self.audit_log.flush()
+        self.assertEqual(len(self.sink.batches), 1)
+        self.assertEqual(self.sink.batches[0][0]['record_id'], '1')
+
+    def test_entries_are_discarded_on_abort(self):
+        request = testing.DummyRequest()
+        self.audit_log.record(request, 'create', 'person', 1, {})
+        transaction.abort()
+        self.audit_log.flush()
+        self.assertEqual(self.sink.batches, [])
+
+    def test_flush_writes_in_batches(self):
+        for i in range(3):
+            self.audit_log.put({'record_id': i})
+        self.audit_log.flush()
+        self.assertEqual([len(b) for b in self.sink.batches], [2, 1])
+
+    def test_full_buffer_drops_entries(self):
+        audit_log = AuditLog(self.sink, max_queue_size=1)
+        audit_log.put({'record_id': 1})
+        audit_log.put({'record_id': 2})
+        self.assertEqual(audit_log.dropped, 1)
+
+    def test_model_update_records_diff(self):
+        def _post_update_response_callback(request, record):
+            return HTTPFound('/')
+
+        person = Person(name='Mr Smith', age=23)
+        person.save()
+        SASession.flush()
+        view = model_update(Person, PersonForm, _post_update_response_callback)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([
+            ('csrf_token', request.session.get_csrf_token()),
+            ('name', 'Mr Smith'),
+            ('age', '24')])
+        view(person, request)
+        transaction.commit()
+        self.audit_log.flush()
+        entry = self.sink.batches[0][0]
+        self.assertEqual(entry['action'], 'update')
+        self.assertEqual(entry['model'], 'person')
+        self.assertEqual(entry['changes'], {'age': (23, 24)})
+
+    def test_password_hashes_are_redacted(self):
+        user = BaseUser(account_id='admin@example.com', _password='hash1')
+        before = user.to_dict()
+        user._password = 'hash2'
+        request = testing.DummyRequest()
+        audit_record(request, 'create', user, before)
+        audit_record(request, 'update', user,
+                     dict_diff(before, user.to_dict()))
+        transaction.commit()
+        self.audit_log.flush()
+        create, update = self.sink.batches[0]
+        self.assertEqual(create['changes']['_password'], '[redacted]')
+        self.assertEqual(create['changes']['account_id'], 'admin@example.com')
+        self.assertEqual(update['changes'], {'_password': '[redacted]'})
+
+    def test_file_sink_writes_json_lines(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        FileAuditSink(path).write([{'action': 'create'}, {'action': 'delete'}])
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
 
 class TestRootFactory(BaseRootFactory):
         pass
@@ -312,6 +1274,7 @@ class TestModelView(FunctionalTestBase):
             'templates/person_list.pt': '{{"title": "People List"}}',
             'templates/person_create.pt': '{{"title": "People Create"}}',
             'templates/person_show.pt': '{{"title": "Person Show"}}',
+            'templates/hobby_list.pt': '{{"title": "Hobby List"}}',
             'templates/person_update.pt': '{{"title": "Person Update",'
                                           '"form_class": "{form_class}"}}',
             # custom templates
@@ -323,11 +1286,15 @@ class TestModelView(FunctionalTestBase):
                                           '"form_class": "{form_class}"}}'
         }
 
+        looked_up = []
+        rendered = []
+
         def __init__(self, info):
-            pass
+            self.looked_up.append(info.name)
 
         def __call__(self, value, system):
             renderer = system['renderer_name']
+            self.rendered.append(renderer)
             response = self.responses[renderer]
             if 'form' in value:
                 response = response.format(
@@ -456,6 +1423,91 @@ class TestModelView(FunctionalTestBase):
         response = testapp.get('/people/1/edit')
         response.mustcontain('Person Custom Update')
 
+    def test_include_model_views_registers_all_views(self):
+        class PersonViews(ModelView):
+            ModelFactoryClass = PersonModelFactory
+            ModelFormClass = PersonForm
+            base_url_override = 'people'
+
+        class HobbyViews(ModelView):
+            ModelFactoryClass = HobbyModelFactory
+            ModelFormClass = HobbyForm
+            enabled_views = (ModelView.LIST,)
+
+        self.TestRenderer.looked_up = []
+        include_model_views(self.config, (PersonViews, HobbyViews))
+        # renderers are only looked up on first use without warm_up
+        self.assertEqual(self.TestRenderer.looked_up, [])
+        self.assertEqual(get_model_views(self.config.registry),
+                         [PersonViews, HobbyViews])
+        testapp = TestApp(self.config.make_wsgi_app())
+
+        response = testapp.get('/people/')
+        response.mustcontain('People List')
+
+        response = testapp.get('/hobby/')
+        response.mustcontain('Hobby List')
+
+    def test_warm_up_looks_up_renderers(self):
+        class PersonViews(ModelView):
+            ModelFactoryClass = PersonModelFactory
+            ModelFormClass = PersonForm
+            base_url_override = 'people'
+
+        self.TestRenderer.looked_up = []
+        include_model_views(self.config, (PersonViews,), warm_up=True)
+        self.assertEqual(self.TestRenderer.looked_up, [
+            'templates/person_list.pt',
+            'templates/person_create.pt',
+            'templates/person_show.pt',
+            'templates/person_update.pt'])
+
+    def test_list_view_cache_is_invalidated_by_table_changes(self):
+        class PersonViews(ModelView):
+            ModelFactoryClass = PersonModelFactory
+            ModelFormClass = PersonForm
+            base_url_override = 'people'
+            list_view_cache = True
+
+        set_cache_backends(MemoryVersionStore(), MemoryRenderCache())
+        self.addCleanup(set_cache_backends, MemoryVersionStore(),
+                        MemoryRenderCache())
+        transaction.commit()
+        PersonViews.include(self.config)
+        testapp = TestApp(self.config.make_wsgi_app())
+        self.TestRenderer.rendered = []
+
+        testapp.get('/people/').mustcontain('People List')
+        testapp.get('/people/').mustcontain('People List')
+        self.assertEqual(len(self.TestRenderer.rendered), 1)
+
+        Person(name='Mrs Smith', age=25).save()
+        transaction.commit()
+        testapp.get('/people/').mustcontain('People List')
+        self.assertEqual(len(self.TestRenderer.rendered), 2)
+
+    def test_cached_render_passes_system_values(self):
+        class PersonViews(ModelView):
+            ModelFactoryClass = PersonModelFactory
+            ModelFormClass = PersonForm
+            base_url_override = 'people'
+            list_view_cache = True
+
+        set_cache_backends(MemoryVersionStore(), MemoryRenderCache())
+        self.addCleanup(set_cache_backends, MemoryVersionStore(),
+                        MemoryRenderCache())
+        events = []
+        self.config.add_subscriber(events.append, BeforeRender)
+        PersonViews.include(self.config)
+        testapp = TestApp(self.config.make_wsgi_app())
+
+        testapp.get('/people/').mustcontain('People List')
+        self.assertEqual(len(events), 1)
+        self.assertIsNotNone(events[0]['view'])
+        self.assertIsInstance(events[0]['context'], PersonModelFactory)
+        self.assertEqual(events[0]['renderer_name'],
+                         'templates/person_list.pt')
+
 
 class TestModelViewResponseCallbacks(FunctionalTestBase):
     def test_create_view_response_override_works(self):
@@ -597,3 +1649,361 @@ class TestLogin(TestBase):
         response = user_login(context, request)
         self.assertIn('csrf_token', response)
         self.assertIn('form', response)
+
+
+class TestLoginThrottle(TestBase):
+    def test_store_refills_tokens(self):
+        store = MemoryThrottleStore()
+        self.assertTrue(store.consume('ip:1', 2, 1.0, now=0))
+        self.assertTrue(store.consume('ip:1', 2, 1.0, now=0))
+        self.assertFalse(store.consume('ip:1', 2, 1.0, now=0))
+        self.assertTrue(store.consume('ip:1', 2, 1.0, now=1))
+
+    def test_store_prunes_refilled_buckets(self):
+        store = MemoryThrottleStore(max_keys=1)
+        store.consume('ip:1', 2, 1.0, now=0)
+        store.consume('ip:2', 2, 1.0, now=10)
+        self.assertEqual(list(store.buckets.keys()), ['ip:2'])
+
+    def test_store_evicts_least_recently_used_buckets(self):
+        store = MemoryThrottleStore(max_keys=2)
+        store.consume('ip:1', 2, 1.0, now=0)
+        store.consume('ip:2', 2, 1.0, now=0)
+        store.consume('ip:1', 2, 1.0, now=0)
+        store.consume('ip:3', 2, 1.0, now=0)
+        self.assertEqual(list(store.buckets.keys()), ['ip:1', 'ip:3'])
+
+    def test_store_prunes_with_each_buckets_refill_rate(self):
+        store = MemoryThrottleStore(max_keys=2)
+        store.consume('account:1', 2, 0.01, now=0)
+        store.consume('ip:1', 2, 1.0, now=0)
+        store.consume('ip:2', 2, 1.0, now=0)
+        self.assertEqual(list(store.buckets.keys()), ['ip:1', 'ip:2'])
+        store.consume('account:1', 2, 0.01, now=10)
+        store.consume('ip:3', 2, 1.0, now=10)
+        self.assertEqual(list(store.buckets.keys()), ['account:1', 'ip:3'])
+
+    def test_throttled_login_is_rejected(self):
+        from .views import user_login
+        self.config.add_route('login', '/login')
+        setup_login_throttle(self.config, account_capacity=1)
+
+        def login():
+            request = testing.DummyRequest()
+            request.client_addr = '10.0.0.1'
+            request.method = 'POST'
+            request.POST = MultiDict([
+                ('csrf_token', request.session.get_csrf_token()),
+                ('account_id', 'admin@example.com'),
+                ('password', 'wrong')])
+            user_login(BaseRootFactory(request), request)
+            return request
+
+        request = login()
+        self.assertEqual(request.session.peek_flash('error'),
+                         [u"Invalid username or password."])
+        request = login()
+        self.assertEqual(request.response.status_code, 429)
+        self.assertEqual(request.session.peek_flash('error'),
+                         [u"Too many login attempts, please try again "
+                          u"later."])
+
+
+class TestPasswordRehash(TestBase):
+    def setUp(self):
+        super(TestPasswordRehash, self).setUp()
+        pwd_context.load({'schemes': ['des_crypt']})
+        self.old_hash = pwd_context.encrypt('admin')
+        pwd_context.load({'schemes': ['pbkdf2_sha256', 'des_crypt'],
+                          'deprecated': ['des_crypt'],
+                          'pbkdf2_sha256__default_rounds': 1000})
+
+    def test_wrapped_hash_verifies_against_password(self):
+        wrapped = wrap_hash(self.old_hash)
+        self.assertTrue(is_wrapped(wrapped))
+        self.assertNotIn(self.old_hash, wrapped)
+        self.assertTrue(verify_wrapped('admin', wrapped))
+        self.assertFalse(verify_wrapped('wrong', wrapped))
+
+    def test_check_password_upgrades_wrapped_hash(self):
+        user = BaseUser(account_id='admin@example.com',
+                        _password=wrap_hash(self.old_hash))
+        self.assertFalse(user.check_password('wrong'))
+        self.assertTrue(is_wrapped(user._password))
+        self.assertTrue(user.check_password('admin'))
+        self.assertTrue(user._password.startswith('$pbkdf2-sha256$'))
+
+    def test_rehash_passwords(self):
+        for i in range(3):
+            BaseUser(account_id='user{0}@example.com'.format(i),
+                     _password=self.old_hash).save()
+        BaseUser(account_id='admin@example.com', password='admin').save()
+        SASession.flush()
+        self.assertEqual(audit_hashes(2), {'des_crypt': [3, 3],
+                                           'pbkdf2_sha256': [1, 0]})
+        self.assertEqual(rehash_passwords(2, 1), (3, 0))
+        self.assertEqual(audit_hashes(2), {'wrapped': [3, 0],
+                                           'pbkdf2_sha256': [1, 0]})
+        user = BaseUser.query().filter_by(
+            account_id='user0@example.com').one()
+        self.assertTrue(user.check_password('admin'))
+
+    def test_store_hashes_skips_changed_hashes(self):
+        user = BaseUser(account_id='admin@example.com',
+                        _password=self.old_hash)
+        user.save()
+        SASession.flush()
+        wrapped = wrap_hash(self.old_hash)
+        self.assertEqual(store_hashes([
+            {'user_id': user.id, 'old_password': 'changed',
+             'new_password': wrapped}]), 0)
+        self.assertEqual(store_hashes([
+            {'user_id': user.id, 'old_password': self.old_hash,
+             'new_password': wrapped}]), 1)
+        SASession.expire_all()
+        self.assertEqual(user._password, wrapped)
+
+
+class TestQueryLimits(TestBase):
+    def setUp(self):
+        super(TestQueryLimits, self).setUp()
+        setup_query_limits(self.config)
+        self.request = testing.DummyRequest()
+        self.config.begin(self.request)
+
+    def test_model_list_max_rows(self):
+        for i in range(3):
+            Person(name='Person {0}'.format(i), age=20).save()
+        SASession.flush()
+        self.assertEqual(len(model_list(Person, max_rows=3)(
+            self.request)['records']), 3)
+        self.assertRaises(TooManyRows, model_list(Person, max_rows=2),
+                          self.request)
+
+    def test_query_count_is_limited(self):
+        def view(context, request):
+            Person.query().all()
+            Hobby.query().all()
+        self.assertRaises(TooManyQueries,
+                          limit_queries({'max_queries': 1})(view),
+                          None, self.request)
+        limit_queries({'max_queries': 2})(view)(None, self.request)
+        self.assertIsNone(self.request.query_budget)
+
+    def test_slow_statement_is_interrupted(self):
+        def view(context, request):
+            SASession.execute(
+                "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL "
+                "SELECT i + 1 FROM r) SELECT count(*) FROM r")
+        self.assertRaises(StatementTimeout,
+                          limit_queries({'statement_timeout': 0.1})(view),
+                          None, self.request)
+
+    def test_only_cancelled_statements_time_out(self):
+        def view(context, request):
+            time.sleep(0.2)
+            SASession.execute("SELECT * FROM missing_table")
+        self.assertRaises(OperationalError,
+                          limit_queries({'statement_timeout': 0.1})(view),
+                          None, self.request)
+
+    def test_traversal_queries_count_towards_the_budget(self):
+        Person(name='Mr Smith', age=23).save()
+        SASession.flush()
+        factory = limit_traversal_queries(PersonModelFactory,
+                                          {'max_queries': 1})
+        root = factory(self.request)
+        root['1']
+
+        def view(context, request):
+            Person.query().all()
+        self.assertRaises(TooManyQueries,
+                          limit_queries({'max_queries': 1})(view),
+                          None, self.request)
+
+    def test_mysql_selects_get_max_execution_time(self):
+        self.assertEqual(add_max_execution_time(" SELECT 1", 1.5),
+                         "SELECT /*+ MAX_EXECUTION_TIME(1500) */ 1")
+        self.assertEqual(add_max_execution_time("UPDATE t SET a = 1", 1.5),
+                         "UPDATE t SET a = 1")
+
+
+class TestFixtures(TestBase):
+    def test_seed_inserts_in_chunks(self):
+        seed(Person, 2500, name=lambda i: 'Person {0}'.format(i), age=30)
+        self.assertEqual(Person.query().count(), 2500)
+        self.assertEqual(Person.query().get(3).name, 'Person 2')
+
+    def test_each_test_is_rolled_back(self):
+        engine = self.engine
+        seed(Person, 3, name=lambda i: 'Person {0}'.format(i), age=30)
+        transaction.commit()
+        self.assertEqual(Person.query().count(), 3)
+        self.tearDown()
+        self.setUp()
+        self.assertIs(self.engine, engine)
+        self.assertEqual(Person.query().count(), 0)
+
+    def test_abort_rolls_back_to_the_last_commit(self):
+        Person(name='Mr Smith', age=23).save()
+        transaction.commit()
+        Person(name='Mrs Smith', age=25).save()
+        SASession.flush()
+        transaction.abort()
+        Person(name='Ms Smith', age=30).save()
+        SASession.flush()
+        self.assertEqual(sorted(p.name for p in Person.query()),
+                         ['Mr Smith', 'Ms Smith'])
+
+
+class TestMetrics(TestBase):
+    def test_thread_shards_are_summed(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.inc('requests_total', action='list')
+
+        def record():
+            metrics.inc('requests_total', action='list')
+            metrics.observe('latency_seconds', 0.5)
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        metrics.observe('latency_seconds', 2)
+        worker = 'worker="{0}"'.format(os.getpid())
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE requests_total counter', lines)
+        self.assertIn('requests_total{{action="list",{0}}} 2'.format(worker),
+                      lines)
+        self.assertIn('latency_seconds_bucket{{{0},le="0.1"}} 0'.format(
+            worker), lines)
+        self.assertIn('latency_seconds_bucket{{{0},le="1.0"}} 1'.format(
+            worker), lines)
+        self.assertIn('latency_seconds_bucket{{{0},le="+Inf"}} 2'.format(
+            worker), lines)
+        self.assertIn('latency_seconds_sum{{{0}}} 2.5'.format(worker), lines)
+
+    def test_form_validation_failures_are_counted(self):
+        metrics = setup_metrics(self.config)
+        self.config.add_route('persons', '/persons/*traverse',
+                              factory=PersonModelFactory)
+        view = model_create(Person, PersonForm, None)
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict([('name', 'Mr Smith'), ('age', 'old')])
+        view(PersonModelFactory(request), request)
+        counters, histograms = metrics.collect()
+        self.assertEqual(counters[(
+            'drypyramid_form_validation_failures_total',
+            (('form', 'PersonForm'),))], 1)
+
+    def test_metrics_endpoint(self):
+        setup_metrics(self.config)
+        app = TestApp(self.config.make_wsgi_app())
+        response = app.get('/metrics')
+        self.assertEqual(response.content_type, 'text/plain')
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_requests_are_picked_by_header_or_rate(self):
+        profiler = Profiler(self.directory, secret='s3cret')
+        request = testing.DummyRequest()
+        self.assertFalse(profiler.wants(request))
+        request.headers['X-Drypyramid-Profile'] = 'wrong'
+        self.assertFalse(profiler.wants(request))
+        request.headers['X-Drypyramid-Profile'] = 's3cret'
+        self.assertTrue(profiler.wants(request))
+        profiler = Profiler(self.directory, sample_rate=1.0)
+        self.assertTrue(profiler.wants(testing.DummyRequest()))
+
+    def test_stacks_are_aggregated_per_route_and_view(self):
+        profiler = Profiler(self.directory, interval=0.001)
+
+        def handler(request):
+            request.profiled_view = (None, 'edit')
+            end = time.time() + 0.05
+            while time.time() < end:
+                pass
+            return 'response'
+
+        request = testing.DummyRequest()
+        self.assertEqual(profiler(handler, request), 'response')
+        profiler(handler, request)
+        profiler.flush()
+        with open(os.path.join(self.directory, '_.edit.collapsed')) as f:
+            lines = f.readlines()
+        self.assertTrue(lines)
+        self.assertIn('tests.py:handler', [
+            line.rsplit(' ', 1)[0].split(';')[-1] for line in lines])
+        self.assertEqual(len(lines), len(set(
+            line.rsplit(' ', 1)[0] for line in lines)))
+
+    def test_only_requests_matching_a_view_are_recorded(self):
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        # testing.setUp autocommits, the deriver must be added first
+        profiler = setup_profiler(config, self.directory, sample_rate=1.0,
+                                  interval=0.001)
+        self.addCleanup(profiler.stop)
+        config.add_route('things', '/things/*traverse')
+        config.add_view(lambda request: Response('ok'), route_name='things',
+                        name='edit')
+        config.add_notfound_view(
+            lambda request: Response('not found', status=404))
+        app = TestApp(config.make_wsgi_app())
+        app.get('/things/edit')
+        app.get('/things/unknown', status=404)
+        profiler.flush()
+        self.assertEqual(os.listdir(self.directory),
+                         ['things.edit.collapsed'])
+
+
+class TestIndexAdvisor(TestBase):
+    class PersonViews(ModelView):
+        ModelFactoryClass = PersonModelFactory
+
+    class ArticleViews(ModelView):
+        ModelFactoryClass = ArticleModelFactory
+
+    class PostViews(ModelView):
+        ModelFactoryClass = PostModelFactory
+
+    def test_reports_missing_indexes(self):
+        missing, redundant = advise(self.connection, [
+            self.PersonViews, self.ArticleViews, self.PostViews])
+        self.assertEqual(sorted([m[:2] for m in missing]), [
+            ('person_hobby', ('person_id',)),
+            ('user_groups', ('group_id',)),
+            ('user_groups', ('user_id',)),
+        ])
+        self.assertEqual(redundant, [])
+        self.assertEqual(
+            create_index_ddl(self.engine.dialect, 'person_hobby',
+                             ('person_id',)),
+            'CREATE INDEX ix_person_hobby_person_id ON person_hobby '
+            '(person_id);')
+
+    def test_reports_redundant_indexes(self):
+        self.connection.execute("CREATE INDEX ix_person_name ON person (name)")
+        self.connection.execute(
+            "CREATE INDEX ix_post_deleted_at ON post (deleted_at)")
+        missing, redundant = advise(self.connection, [])
+        self.assertEqual(sorted(redundant), [
+            ('person', 'ix_person_name', ('name',), 'UNIQUE (name)'),
+            ('post', 'ix_post_deleted_at', ('deleted_at',),
+             'ix_post_deleted_at_id'),
+        ])
+
+
+class TestRenderCache(unittest.TestCase):
+    def test_evicts_least_recently_used_entries(self):
+        cache = MemoryRenderCache(max_bytes=10)
+        cache.set('a', (b'12345', 'text/html'))
+        cache.set('b', (b'12345', 'text/html'))
+        cache.get('a')
+        cache.set('c', (b'12345', 'text/html'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.size, 10)
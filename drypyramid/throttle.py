@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+LOGIN_THROTTLE_KEY = 'drypyramid.login_throttle'
+
+
+class MemoryThrottleStore(object):
+    """In-process token buckets, each worker process throttles on its own.
+
+    A shared store e.g. backed by redis only needs to implement consume with
+    the same signature"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # least recently used first
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_rate, now=None):
+        """Take a token from key's bucket, refilled at refill_rate tokens per
+        second up to capacity. Returns False if the bucket is empty"""
+        now = time.time() if now is None else now
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))[:2]
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now, capacity, refill_rate)
+            if len(self.buckets) > self.max_keys:
+                self.prune(now)
+        return allowed
+
+    def prune(self, now):
+        """Drop the least recently used buckets that have refilled, they are
+        the same as missing ones, then evict the least recently used until
+        there are max_keys left"""
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            tokens, updated, capacity, refill_rate = bucket
+            if len(self.buckets) <= self.max_keys and\
+                    tokens + (now - updated) * refill_rate < capacity:
+                break
+            del self.buckets[key]
+
+
+class LoginThrottle(object):
+    """Limits login attempts per account and per client IP, the defaults
+    allow bursts of 5 attempts per account and 20 per IP refilling at 1 per
+    minute and 1 every 6 seconds respectively"""
+
+    def __init__(self, store=None, account_capacity=5,
+                 account_refill_rate=1 / 60.0, ip_capacity=20,
+                 ip_refill_rate=1 / 6.0):
+        self.store = store if store is not None else MemoryThrottleStore()
+        self.account_capacity = account_capacity
+        self.account_refill_rate = account_refill_rate
+        self.ip_capacity = ip_capacity
+        self.ip_refill_rate = ip_refill_rate
+
+    def allow(self, client_addr, account_id):
+        return self.store.consume(
+            u'ip:{0}'.format(client_addr), self.ip_capacity,
+            self.ip_refill_rate) and self.store.consume(
+            u'account:{0}'.format(account_id), self.account_capacity,
+            self.account_refill_rate)
+
+
+def setup_login_throttle(config, **kwargs):
+    """Throttle user_login attempts, kwargs are passed to LoginThrottle"""
+    throttle = LoginThrottle(**kwargs)
+    config.registry[LOGIN_THROTTLE_KEY] = throttle
+    return throttle
+
+
+def get_login_throttle(request):
+    return request.registry.get(LOGIN_THROTTLE_KEY)
@@ -1,16 +1,44 @@
+import datetime
+from decimal import Decimal
+
 from pyramid.httpexceptions import (
     HTTPBadRequest,
+    HTTPConflict,
     HTTPFound,
 )
 from pyramid.security import (
     remember,
     forget,
+    has_permission,
 )
+from pyramid.renderers import RendererHelper
 from deform import Form, ValidationFailure, Button
+from sqlalchemy import and_, Boolean
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.exc import NoResultFound
-from .models import SASession, BaseUser
-from .forms import UserLoginForm
+from sqlalchemy.orm.exc import NoResultFound, StaleDataError
+from .models import (
+    SASession,
+    BaseUser,
+    Versioned,
+    SoftDeletable,
+    Slugable,
+    coerce_value,
+    listen_for_table_changes,
+)
+from .forms import UserLoginForm, form_cache
+from . import audit
+from .audit import audit_record, get_audit_log
+from .throttle import get_login_throttle
+from .cache import cached_render
+from .limits import (
+    TooManyRows,
+    limit_queries,
+    limit_traversal_queries,
+)
+from .metrics import count, metered_view
+
+# shared so cached forms can be keyed on them
+FORM_BUTTONS = ("save", Button('reset', "Reset", 'reset'))
 
 
 def check_post_csrf(func):
@@ -24,14 +52,47 @@ def check_post_csrf(func):
     return inner
 
 
-def model_list(model):
+def model_list(model, columns=None, max_rows=None):
+    """If columns is set, only those columns are fetched and records are
+    lightweight row tuples instead of model instances. The id, and the slug
+    of Slugable models, are always fetched so the factory's url helpers still
+    work.
+
+    Raises TooManyRows if there are more than max_rows records"""
+    if columns:
+        if 'id' not in columns:
+            columns = ('id',) + tuple(columns)
+        if issubclass(model, Slugable):
+            slug_key = model.slug_target_column().key
+            if slug_key not in columns:
+                columns = tuple(columns) + (slug_key,)
+        attributes = [getattr(model, c) for c in columns]
+
     def list(request):
         # todo: paginate
-        records = model.query().all()
+        if columns:
+            query = SASession.query(*attributes)
+            if issubclass(model, SoftDeletable):
+                query = query.filter(model.deleted_at == None)
+        else:
+            query = model.query()
+        if max_rows is not None:
+            records = query.limit(max_rows + 1).all()
+            if len(records) > max_rows:
+                raise TooManyRows()
+        else:
+            records = query.all()
         return {'records': records}
     return list
 
 
+def context_view(view):
+    """Adapt a view taking just the request to (context, request)"""
+    def inner(context, request):
+        return view(request)
+    return inner
+
+
 def model_show(model):
     def show(context, request):
         return {'record': context}
@@ -39,27 +100,39 @@ def model_show(model):
 
 
 def model_create(model, schema, post_save_response_callback,
-                 pre_save_callback=None):
+                 pre_save_callback=None, ignore_duplicates=False):
+    """If ignore_duplicates is True, the record is inserted with the
+    dialect's insert-or-ignore and a duplicate is reported as an error instead
+    of raising an IntegrityError, no pre-query for unique values is needed"""
     def create(context, request):
-        form = Form(schema.__call__().bind(), buttons=(
-            "save", Button('reset', "Reset", 'reset')))
+        form = form_cache.get_form(schema, buttons=FORM_BUTTONS)
         if request.method == 'POST':
             data = request.POST.items()
             try:
                 values = form.validate(data)
             except ValidationFailure:
+                count(request, 'drypyramid_form_validation_failures_total',
+                      form=schema.__name__)
                 request.session.flash(
                     u"Please fix the errors indicated below.", "error")
             else:
                 record = model.create_from_dict(dict(values))
                 if pre_save_callback:
                     pre_save_callback(request, record, values)
-                record.save()
-                #try:
-                SASession.flush()
-                #except IntegrityError:
-                #    request.session.flash("A duplicate record exists", "error")
-                #else:
+                if ignore_duplicates:
+                    if not record.insert_or_ignore():
+                        request.session.flash(
+                            u"A duplicate record exists.", "error")
+                        return {'form': form}
+                else:
+                    record.save()
+                    #try:
+                    SASession.flush()
+                    #except IntegrityError:
+                    #    request.session.flash("A duplicate record exists",
+                    #                          "error")
+                    #else:
+                audit_record(request, audit.CREATE, record, record.to_dict())
                 request.session.flash(
                     u"Your changes have been saved.", "success")
                 return post_save_response_callback(request, record)
@@ -71,44 +144,202 @@ def model_update(model, schema, post_save_response_callback,
                  pre_save_callback=None):
     def update(context, request):
         record = context
-        form = Form(schema.__call__().bind(pk=record.id),
-                    buttons=("save", Button('reset', "Reset", 'reset')),
-                    appstruct=record.to_dict())
+        appstruct = record.to_dict()
+        form = form_cache.get_form(schema, {'pk': record.id},
+                                   buttons=FORM_BUTTONS,
+                                   appstruct=appstruct)
         if request.method == 'POST':
             data = request.POST.items()
             try:
                 values = form.validate(data)
             except ValidationFailure:
+                count(request, 'drypyramid_form_validation_failures_total',
+                      form=schema.__name__)
                 request.session.flash(
                     u"Please fix the errors indicated below.", "error")
             else:
-                record.update_from_dict(dict(values))
+                data = dict(values)
+                if isinstance(record, Versioned) and\
+                        record.is_stale(data.pop('version', None)):
+                    request.response.status_code = 409
+                    request.session.flash(
+                        u"This record was changed by someone else, please "
+                        u"reload it and try again.", "error")
+                    return {'form': form, 'record': record}
+                changed = record.update_from_dict(data)
                 if pre_save_callback:
                     pre_save_callback(request, record, values)
-                record.save()
-                request.session.flash(
-                    u"Your changes have been saved.", "success")
+                # the callback may have made its own changes
+                if changed or SASession.is_modified(record):
+                    record.save()
+                    if isinstance(record, Versioned):
+                        # a concurrent update since we loaded the record
+                        # fails the version check here
+                        try:
+                            SASession.flush()
+                        except StaleDataError:
+                            raise HTTPConflict(
+                                "This record was changed by someone else.")
+                    audit_record(request, audit.UPDATE, record,
+                                 audit.dict_diff(appstruct, record.to_dict()))
+                    request.session.flash(
+                        u"Your changes have been saved.", "success")
+                else:
+                    request.session.flash(
+                        u"No changes were made.", "info")
                 return post_save_response_callback(request, record)
         return {'form': form, 'record': record}
     return update
 
 
-def model_delete(post_delete_response_callback):
+def model_delete(post_delete_response_callback, direct=False):
+    """If direct is True, the record is deleted with a DELETE by primary key
+    instead of through the session, which would load its related collections
+    first"""
     def delete(context, request):
         record = context
-        record.delete()
+        audit_record(request, audit.DELETE, record, record.to_dict())
+        # soft deletes are already a single row update
+        if direct and not isinstance(record, SoftDeletable):
+            SASession.expunge(record)
+            record.__class__.delete_by_ids([record.id])
+        else:
+            record.delete()
         request.session.flash(
             u"The record has been deleted.", "success")
         return post_delete_response_callback(request, record)
     return delete
 
 
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date,
+                          datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def record_json(record):
+    """record's values for a JSON response, without its
+    __redacted_columns__"""
+    return dict([(key, json_value(value))
+                 for key, value in record.to_dict().items()
+                 if key not in record.__redacted_columns__])
+
+
+def model_batch_show(permission, max_ids=500):
+    """Fetch the records in ?ids=1,2,3 with a single query, dropping those
+    the user isn't permitted to view"""
+    def batch_show(context, request):
+        keys = []
+        seen = set()
+        for key in request.GET.get('ids', '').split(','):
+            # repeated ids are only returned once, in request order
+            if key and key not in seen:
+                seen.add(key)
+                keys.append(key)
+        if not keys or len(keys) > max_ids:
+            return HTTPBadRequest(
+                "Between 1 and {0} ids are required.".format(max_ids))
+        records = [record for record in context.get_many(keys)
+                   if has_permission(permission, record, request)]
+        return {'records': [record_json(record) for record in records]}
+    return batch_show
+
+
+def model_changes(model, page_size=500, lag=0):
+    """Records of a ChangeTracked model created, updated or deleted since the
+    ?cursor= sequence number. Clients pass the returned cursor back until
+    has_more is False. Changes show up once they're lag seconds old, see
+    ChangeTracked.changes_since"""
+    def changes(context, request):
+        try:
+            cursor = int(request.GET.get('cursor', 0))
+            limit = min(int(request.GET.get('limit', page_size)), page_size)
+        except ValueError:
+            return HTTPBadRequest("cursor and limit must be integers.")
+        records, has_more = model.changes_since(cursor, max(limit, 1), lag)
+        if records:
+            cursor = records[-1][0]
+        return {
+            'changes': [{'seq': seq,
+                         'id': record_id,
+                         'deleted': record is None,
+                         'record': record_json(record) if record else None}
+                        for seq, record_id, record in records],
+            'cursor': cursor,
+            'has_more': has_more,
+        }
+    return changes
+
+
+def model_bulk_delete(model, chunk_size=1000):
+    """Delete up to chunk_size records matching the POSTed column values,
+    clients repeat the request until nothing remains. SoftDeletable records
+    are marked as deleted, purge_deleted hard deletes them later"""
+    columns = model.__mapper__.columns
+
+    def bulk_delete(context, request):
+        criteria = []
+        for key, value in request.POST.items():
+            if key not in columns:
+                continue
+            value = coerce_value(columns[key], value)
+            if isinstance(columns[key].type, Boolean) and\
+                    not isinstance(value, bool):
+                return HTTPBadRequest(
+                    "{0} must be true, false, 1 or 0.".format(key))
+            criteria.append(columns[key] == value)
+        if not criteria:
+            return HTTPBadRequest("At least one filter is required.")
+        if issubclass(model, SoftDeletable):
+            criteria.append(model.deleted_at == None)
+            delete_where = model.soft_delete_where
+        else:
+            delete_where = model.delete_where
+        criterion = and_(*criteria)
+        deleted = delete_where(criterion, chunk_size=chunk_size, max_chunks=1)
+        remaining = deleted == chunk_size and\
+            SASession.query(model.id).filter(criterion).first() is not None
+        return {'deleted': deleted, 'remaining': remaining}
+    return bulk_delete
+
+
+MODEL_VIEWS_KEY = 'drypyramid.model_views'
+
+
+def get_model_views(registry):
+    """Return the ModelView classes included into the registry"""
+    return registry.get(MODEL_VIEWS_KEY, [])
+
+
+def include_model_views(config, view_classes, warm_up=False):
+    """Include several ModelViews in one step.
+
+    If warm_up is True, their templates are compiled and their forms built
+    when the configuration is committed e.g. on make_wsgi_app
+    """
+    for view_class in view_classes:
+        view_class.include(config)
+
+    if warm_up:
+        def warm_up_views():
+            for view_class in view_classes:
+                view_class.warm_up(config)
+        # runs after renderer factories have been registered
+        config.action(None, warm_up_views)
+
+
 class ModelView(object):
     LIST = 'list'
     CREATE = 'create'
     SHOW = 'show'
     UPDATE = 'update'
     DELETE = 'delete'
+    BULK_DELETE = 'bulk_delete'
+    CHANGES = 'changes'
+    BATCH = 'batch'
 
     enabled_views = (LIST, CREATE, SHOW, UPDATE, DELETE)
 
@@ -121,17 +352,48 @@ class ModelView(object):
 
     list_view_renderer = 'templates/{route_name}_list.pt'
     list_view_permission = 'list'
+    # names of the columns the list template shows, fetches full records if
+    # None
+    list_view_columns = None
+    # cache rendered responses until the model's table changes, only for
+    # templates that don't render per-session data e.g. flash messages
+    list_view_cache = False
+    # respond with a 413 instead of listing more records
+    list_view_max_rows = None
 
     create_view_renderer = 'templates/{route_name}_create.pt'
     create_view_permission = 'create'
+    # insert-or-ignore instead of flushing, duplicates become an error
+    create_view_ignore_duplicates = False
 
     show_view_renderer = 'templates/{route_name}_show.pt'
     show_view_permission = 'view'
+    show_view_cache = False
 
     update_view_renderer = 'templates/{route_name}_update.pt'
     update_view_permission = 'update'
 
     delete_view_permission = 'delete'
+    # delete with a DELETE by primary key instead of through the session
+    delete_view_direct = False
+
+    bulk_delete_view_permission = 'delete'
+    bulk_delete_chunk_size = 1000
+
+    batch_view_max_ids = 500
+
+    changes_view_permission = 'list'
+    changes_page_size = 500
+    # seconds a change waits before it's listed so that transactions
+    # committing out of order aren't skipped, longer than the slowest
+    # transaction
+    changes_lag = 10
+
+    # e.g. {'statement_timeout': 5, 'max_queries': 50}, the timeout is in
+    # seconds. {action}_view_query_limits entries override these per action,
+    # traversal is limited by these alone. Enforced once setup_query_limits
+    # has been called
+    query_limits = {}
 
     @classmethod
     def get_route_name(cls):
@@ -151,9 +413,30 @@ class ModelView(object):
 
     @classmethod
     def setup_route(cls, config):
+        factory = cls.ModelFactoryClass
+        if cls.query_limits:
+            factory = limit_traversal_queries(factory, cls.query_limits)
         config.add_route('{0}'.format(cls.get_route_name()),
                          '/{0}/*traverse'.format(cls.get_base_url()),
-                         factory=cls.ModelFactoryClass)
+                         factory=factory)
+
+    @classmethod
+    def cached_view(cls, config, view, renderer_name):
+        listen_for_table_changes()
+        ModelClass = cls.ModelFactoryClass.ModelClass
+        table_names = [t.name for t in ModelClass.__mapper__.tables] +\
+            [c.table.name for c in ModelClass.association_columns()]
+        return cached_render(view, renderer_name, table_names,
+                             package=config.package)
+
+    @classmethod
+    def view_decorators(cls, action):
+        decorators = (metered_view(cls.get_route_name(), action),)
+        limits = dict(cls.query_limits, **getattr(
+            cls, '{0}_view_query_limits'.format(action), {}))
+        if limits:
+            decorators += (limit_queries(limits),)
+        return decorators
 
     @classmethod
     def setup_views(cls, config):
@@ -162,29 +445,45 @@ class ModelView(object):
         base_url = cls.get_base_url()
 
         if 'list' in cls.enabled_views:
-            config.add_view(model_list(ModelClass),
+            list_view = model_list(ModelClass, cls.list_view_columns,
+                                   cls.list_view_max_rows)
+            list_view_renderer = cls.list_view_renderer.format(
+                route_name=route_name)
+            if cls.list_view_cache:
+                list_view = cls.cached_view(
+                    config, context_view(list_view), list_view_renderer)
+            config.add_view(list_view,
                             context=cls.ModelFactoryClass,
                             route_name=route_name,
-                            renderer=cls.list_view_renderer.format(
-                                route_name=route_name),
-                            permission=cls.list_view_permission)
+                            renderer=list_view_renderer,
+                            permission=cls.list_view_permission,
+                            decorator=cls.view_decorators(cls.LIST))
 
         if 'create' in cls.enabled_views:
             config.add_view(model_create(ModelClass, cls.ModelFormClass,
-                                         cls.post_create_response_callback),
+                                         cls.post_create_response_callback,
+                                         ignore_duplicates=cls.
+                                         create_view_ignore_duplicates),
                             context=cls.ModelFactoryClass,
                             route_name=route_name, name='add',
                             renderer=cls.create_view_renderer.format(
                                 route_name=route_name),
-                            permission=cls.create_view_permission)
+                            permission=cls.create_view_permission,
+                            decorator=cls.view_decorators(cls.CREATE))
 
         if 'show' in cls.enabled_views:
-            config.add_view(model_show(ModelClass),
+            show_view = model_show(ModelClass)
+            show_view_renderer = cls.show_view_renderer.format(
+                route_name=route_name)
+            if cls.show_view_cache:
+                show_view = cls.cached_view(config, show_view,
+                                            show_view_renderer)
+            config.add_view(show_view,
                             context=ModelClass,
                             route_name=route_name,
-                            renderer=cls.show_view_renderer.format(
-                                route_name=route_name),
-                            permission=cls.show_view_permission)
+                            renderer=show_view_renderer,
+                            permission=cls.show_view_permission,
+                            decorator=cls.view_decorators(cls.SHOW))
 
         if 'update' in cls.enabled_views:
             config.add_view(model_update(ModelClass, cls.ModelUpdateFormClass
@@ -195,25 +494,104 @@ class ModelView(object):
                             name='edit',
                             renderer=cls.update_view_renderer.format(
                                 route_name=route_name),
-                            permission=cls.update_view_permission)
+                            permission=cls.update_view_permission,
+                            decorator=cls.view_decorators(cls.UPDATE))
 
         if 'delete' in cls.enabled_views:
-            config.add_view(model_delete(cls.post_delete_response_callback),
+            config.add_view(model_delete(cls.post_delete_response_callback,
+                                         cls.delete_view_direct),
                             context=ModelClass, route_name=route_name,
                             name='delete',
                             permission=cls.delete_view_permission,
-                            request_method='POST', check_csrf=True)
+                            request_method='POST', check_csrf=True,
+                            decorator=cls.view_decorators(cls.DELETE))
+
+        if 'batch' in cls.enabled_views:
+            # each record is also checked against show_view_permission
+            config.add_view(model_batch_show(cls.show_view_permission,
+                                             cls.batch_view_max_ids),
+                            context=cls.ModelFactoryClass,
+                            route_name=route_name, name='batch',
+                            renderer='json',
+                            permission=cls.list_view_permission,
+                            decorator=cls.view_decorators(cls.BATCH))
+
+        if 'changes' in cls.enabled_views:
+            config.add_view(model_changes(ModelClass, cls.changes_page_size,
+                                          cls.changes_lag),
+                            context=cls.ModelFactoryClass,
+                            route_name=route_name, name='changes',
+                            renderer='json',
+                            permission=cls.changes_view_permission,
+                            decorator=cls.view_decorators(cls.CHANGES))
+
+        if 'bulk_delete' in cls.enabled_views:
+            config.add_view(model_bulk_delete(ModelClass,
+                                              cls.bulk_delete_chunk_size),
+                            context=cls.ModelFactoryClass,
+                            route_name=route_name, name='delete',
+                            renderer='json',
+                            permission=cls.bulk_delete_view_permission,
+                            request_method='POST', check_csrf=True,
+                            decorator=cls.view_decorators(cls.BULK_DELETE))
+
+    @classmethod
+    def get_renderers(cls):
+        """Return the renderer names used by the enabled views"""
+        route_name = cls.get_route_name()
+        renderers = []
+        for view_name in (cls.LIST, cls.CREATE, cls.SHOW, cls.UPDATE):
+            if view_name in cls.enabled_views:
+                renderer = getattr(cls, '{0}_view_renderer'.format(view_name))
+                renderers.append(renderer.format(route_name=route_name))
+        return renderers
+
+    @classmethod
+    def get_form_classes(cls):
+        """Return (form_class, bind_kwargs) tuples for the enabled form views
+        """
+        form_classes = []
+        if cls.CREATE in cls.enabled_views:
+            form_classes.append((cls.ModelFormClass, {}))
+        if cls.UPDATE in cls.enabled_views:
+            form_classes.append((cls.ModelUpdateFormClass
+                                 if cls.ModelUpdateFormClass
+                                 else cls.ModelFormClass, {'pk': None}))
+        return form_classes
+
+    @classmethod
+    def warm_up(cls, config):
+        """Compile the templates and build the forms used by this view's
+        routes so the first requests don't have to"""
+        for renderer_name in cls.get_renderers():
+            renderer = RendererHelper(
+                name=renderer_name, package=config.package,
+                registry=config.registry).renderer
+            # chameleon templates are loaded and cooked lazily
+            template = getattr(renderer, 'template', None)
+            cook_check = getattr(template, 'cook_check', None)
+            if cook_check is not None:
+                cook_check()
+
+        for form_class, bind_kwargs in cls.get_form_classes():
+            if form_class is not None:
+                form = form_cache.get_form(form_class, bind_kwargs,
+                                           buttons=FORM_BUTTONS)
+                # renders and caches deform's widget templates
+                form.render()
 
     @classmethod
     def include(cls, config):
         cls.setup_model(config)
         cls.setup_route(config)
         cls.setup_views(config)
+        config.registry.setdefault(MODEL_VIEWS_KEY, []).append(cls)
 
     @classmethod
     def post_save_response(cls, request, record):
-        return HTTPFound(request.route_url(cls.get_route_name(),
-                                           traverse=(record.id, 'edit')))
+        return HTTPFound(request.route_url(
+            cls.get_route_name(),
+            traverse=(cls.ModelFactoryClass.get_record_key(record), 'edit')))
 
     @classmethod
     def post_delete_response(cls, request, record):
@@ -225,6 +603,14 @@ class ModelView(object):
     post_delete_response_callback = post_delete_response
 
 
+def audit_login(request, action, account_id, user_id=None):
+    count(request, 'drypyramid_logins_total', result=action)
+    audit_log = get_audit_log(request)
+    if audit_log is not None:
+        audit_log.record(request, action, BaseUser.__tablename__, user_id,
+                         {'account_id': account_id})
+
+
 @check_post_csrf
 def user_login(context, request):
     login_url = request.route_url('login')
@@ -242,26 +628,42 @@ def user_login(context, request):
         try:
             values = form.validate(data)
         except ValidationFailure:
+            count(request, 'drypyramid_form_validation_failures_total',
+                  form=UserLoginForm.__name__)
             request.session.flash(
                 u"Please fix the errors indicated below.", "error")
         else:
             account_id = values['account_id']
             password = values['password']
-            try:
-                user = BaseUser.query().filter(
-                    BaseUser.account_id == account_id).one()
-            except NoResultFound:
+            throttle = get_login_throttle(request)
+            # rejected before the user query and password hashing
+            if throttle is not None and not throttle.allow(
+                    request.client_addr, account_id):
+                request.response.status_code = 429
+                count(request, 'drypyramid_logins_total', result='throttled')
                 request.session.flash(
-                    u"Invalid username or password.", "error")
+                    u"Too many login attempts, please try again later.",
+                    "error")
             else:
-                if user.check_password(password):
-                    if 'came_from' in request.session:
-                        del request.session['came_from']
-                    headers = remember(request, user.id)
-                    return HTTPFound(came_from, headers=headers)
-                else:
+                try:
+                    user = BaseUser.query().filter(
+                        BaseUser.account_id == account_id).one()
+                except NoResultFound:
+                    audit_login(request, audit.LOGIN_FAILED, account_id)
                     request.session.flash(
                         u"Invalid username or password.", "error")
+                else:
+                    if user.check_password(password):
+                        audit_login(request, audit.LOGIN, account_id, user.id)
+                        if 'came_from' in request.session:
+                            del request.session['came_from']
+                        headers = remember(request, user.id)
+                        return HTTPFound(came_from, headers=headers)
+                    else:
+                        audit_login(request, audit.LOGIN_FAILED, account_id,
+                                    user.id)
+                        request.session.flash(
+                            u"Invalid username or password.", "error")
 
     request.session['came_from'] = referrer
     csrf_token = request.session.get_csrf_token()
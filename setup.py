@@ -35,10 +35,16 @@ setup(
     author='Larry Weya',
     author_email='larryweya@gmail.com',
     url='',
-    packages=['drypyramid'],
+    packages=['drypyramid', 'drypyramid.scripts'],
     include_package_data=True,
     zip_safe=False,
     test_suite='drypyramid',
     install_requires=requires,
     license='See LICENSE.txt',
+    entry_points="""\
+    [console_scripts]
+    drypyramid_purge = drypyramid.scripts.purge:main
+    drypyramid_rehash = drypyramid.scripts.rehash:main
+    drypyramid_indexes = drypyramid.scripts.indexes:main
+    """,
 )